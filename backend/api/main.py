@@ -1,13 +1,17 @@
+import asyncio
 import json
 import os
-from typing import List, Optional
+import time
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
 from uuid import uuid4
 
 import asyncpg
 import uvicorn
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, parse_obj_as, validator
 from redis import asyncio as aioredis
 import aiohttp
 
@@ -19,6 +23,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-After"],  # the cursor of the next page of datapoints
 )
 
 host = os.environ.get("POSTGRES_HOST", "localhost")
@@ -28,6 +33,44 @@ database = os.environ.get("POSTGRES_DB", "iot_devices")
 DATABASE_URL = f"postgresql://{user}:{password}@{host}/{database}"
 ORION_URL = os.environ.get("ORION_URL", "http://localhost:1026")
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
+FIWARE_SERVICE = os.environ.get("FIWARE_SERVICE", "gateway")
+FIWARE_SERVICEPATH = os.environ.get("FIWARE_SERVICEPATH", "/gateway")
+STATUS_CACHE_TTL = float(os.environ.get("STATUS_CACHE_TTL", 5))
+ORION_QUERY_SIZE = 1000  # entities per /v2/op/query request and page
+STREAM_PREFETCH = 500  # rows fetched from the cursor and sent at once when streaming datapoints
+CONTROL_PROTOCOL_VERSION = 2  # version of the entries of the manage_topics stream, see backend/gateway/control.py
+CONTROL_BATCH_SIZE = 1000  # maximum number of topics in a single entry of the manage_topics stream
+STREAM_MAXLEN = int(os.environ.get("STREAM_MAXLEN", 100000))  # approximate number of entries kept in the stream
+
+# Adds entries to the manage_topics stream (KEYS[1]), each with the next version of the configuration (KEYS[2]).
+# ARGV holds the protocol version, the maximum length of the stream and the operation and topics of each entry.
+# The script runs atomically, so the config versions of the entries in the stream are consecutive and in order,
+# and a gateway that sees a gap knows that it missed changes, e.g. because the stream was trimmed.
+SEND_COMMANDS_SCRIPT = """
+local version = 0
+for i = 3, #ARGV, 2 do
+    version = redis.call('INCR', KEYS[2])
+    redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*',
+        'version', ARGV[1], 'config_version', version, 'op', ARGV[i], 'topics', ARGV[i + 1])
+end
+return version
+"""
+
+# the column of each field of a datapoint, Postgres folds the unquoted column name of matchDatapoint to lower case
+DATAPOINT_COLUMNS = {
+    "object_id": "object_id",
+    "jsonpath": "jsonpath",
+    "topic": "topic",
+    "entity_id": "entity_id",
+    "entity_type": "entity_type",
+    "attribute_name": "attribute_name",
+    "description": "description",
+    "matchDatapoint": 'matchdatapoint AS "matchDatapoint"',
+    "coalesce_updates": "coalesce_updates",
+}
+
+# (entity_id, entity_type, attribute_name) -> (expiry, whether the attribute exists in Orion)
+status_cache: Dict[Tuple[str, Optional[str], str], Tuple[float, bool]] = {}
 
 
 # Pydantic model
@@ -40,6 +83,27 @@ class Datapoint(BaseModel):
     attribute_name: Optional[str] = Field(None, min_length=1, max_length=255)
     description: Optional[str] = ""
     matchDatapoint: Optional[bool] = False
+    coalesce_updates: Optional[bool] = False  # only forward the newest pending value
+
+    @validator("topic")
+    def valid_topic(cls, topic):
+        """
+        The topic may be an MQTT topic filter, e.g. devices/+/telemetry or devices/#, to register a datapoint
+        for all matching topics. Wildcards have to take up a whole level, and # has to be the last level.
+        """
+        if not topic:
+            raise ValueError("topic must not be empty")
+        levels = topic.split("/")
+        for i, level in enumerate(levels):
+            if ("+" in level or "#" in level) and len(level) > 1:
+                raise ValueError("wildcards must take up a whole topic level")
+            if level == "#" and i != len(levels) - 1:
+                raise ValueError("# must be the last topic level")
+        return topic
+
+
+class DatapointStatus(Datapoint):
+    status: bool = False  # whether the entity/attribute pair exists in the Context Broker
 
 
 class DatapointUpdate(BaseModel):
@@ -48,6 +112,99 @@ class DatapointUpdate(BaseModel):
     entity_type: Optional[str] = Field(None, min_length=1, max_length=255)
     attribute_name: Optional[str] = Field(None, min_length=1, max_length=255)
     description: Optional[str] = ""
+    coalesce_updates: Optional[bool] = False
+
+
+# The migrations of the database schema, the version of a migration is its position in the list starting at 1.
+# Migrations are only ever appended, an applied migration must not be changed. The first ones are idempotent,
+# since they were applied on every startup before the schema was versioned.
+MIGRATIONS = [
+    (
+        "create the datapoints table",
+        [
+            """CREATE TABLE IF NOT EXISTS datapoints (
+                object_id TEXT PRIMARY KEY,
+                jsonpath TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                entity_id TEXT,
+                entity_type TEXT,
+                attribute_name TEXT,
+                description TEXT,
+                matchDatapoint BOOLEAN DEFAULT FALSE
+            )"""
+        ],
+    ),
+    (
+        "add coalesce_updates to the datapoints",
+        [
+            """ALTER TABLE datapoints ADD COLUMN IF NOT EXISTS coalesce_updates BOOLEAN DEFAULT FALSE"""
+        ],
+    ),
+    (
+        "index the datapoints by topic",
+        [
+            # text_pattern_ops also serves the topic prefix filter, not only lookups of a topic
+            """CREATE INDEX IF NOT EXISTS datapoints_topic_idx ON datapoints (topic text_pattern_ops)"""
+        ],
+    ),
+    (
+        "index the datapoints by entity",
+        [
+            """CREATE INDEX IF NOT EXISTS datapoints_entity_idx ON datapoints (entity_id, entity_type)"""
+        ],
+    ),
+    (
+        "count the datapoints of each topic",
+        [
+            """CREATE TABLE IF NOT EXISTS topics (
+                topic TEXT PRIMARY KEY,
+                datapoints INTEGER NOT NULL
+            )""",
+            """INSERT INTO topics (topic, datapoints) SELECT topic, count(*) FROM datapoints GROUP BY topic
+            ON CONFLICT (topic) DO NOTHING""",
+        ],
+    ),
+]
+MIGRATION_LOCK = 0x10D47A  # key of the advisory lock held while migrating
+
+
+async def migrate(connection: asyncpg.Connection):
+    """
+    Bring the database schema up to date by applying the migrations that have not been applied yet. The applied versions are
+    recorded in the schema_migrations table. All migrations are applied in one transaction while holding an advisory lock,
+    so that several API processes starting at the same time do not apply a migration twice.
+
+    Args:
+        connection (asyncpg.Connection): The connection to the database.
+    """
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK)
+        await connection.execute(
+            """CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )"""
+        )
+        applied = {
+            row["version"]
+            for row in await connection.fetch("SELECT version FROM schema_migrations")
+        }
+        if applied and max(applied) > len(MIGRATIONS):
+            print(
+                f"The database schema has version {max(applied)}, which is newer than the latest known version {len(MIGRATIONS)}"
+            )
+        for version, (description, statements) in enumerate(MIGRATIONS, start=1):
+            if version in applied:
+                continue
+            for statement in statements:
+                await connection.execute(statement)
+            await connection.execute(
+                """INSERT INTO schema_migrations (version, description) VALUES ($1, $2)""",
+                version,
+                description,
+            )
+            print(f"Applied migration {version}: {description}")
 
 
 @app.on_event("startup")
@@ -56,7 +213,7 @@ async def startup():
     Create a pool of connections to the database. This is to ensure that the gateway does not have to create a new connection
     to the database for every request. Instead, it can reuse an existing connection from the pool for efficiency.
     Moreover, create a connection to the redis cache to store the subscriptions to the topics and a connection to another redis cache
-    to store the notifications to the database.
+    to store the notifications to the database. Finally, bring the schema of the database up to date.
     """
     app.state.pool = await asyncpg.create_pool(DATABASE_URL)
     app.state.redis = await aioredis.from_url(
@@ -65,31 +222,102 @@ async def startup():
     app.state.notifier = await aioredis.from_url(
         REDIS_URL + "/1"
     )  # different db for notifications
+    # one session for all requests to the Context Broker
+    app.state.orion = aiohttp.ClientSession()
+    app.state.send_commands = app.state.notifier.register_script(SEND_COMMANDS_SCRIPT)
 
     async with app.state.pool.acquire() as connection:
         # async with is used to ensure that the connection is released back to the pool after the request is done
-        await connection.execute(
-            """CREATE TABLE IF NOT EXISTS datapoints (
-                object_id TEXT PRIMARY KEY,
-                jsonpath TEXT NOT NULL,
-                topic TEXT NOT NULL,
-                entity_id TEXT,
-                entity_type TEXT,
-                attribute_name TEXT,
-                description TEXT,
-                matchDatapoint BOOLEAN DEFAULT FALSE
-            )"""
-        )
+        await migrate(connection)
 
 
 @app.on_event("shutdown")
 async def shutdown():
     """
-    Close the pool of connections to the PostgreSQL database and the connection to the redis caches.
+    Close the pool of connections to the PostgreSQL database, the connection to the redis caches and the session to the Context Broker.
     """
     await app.state.pool.close()
     await app.state.redis.close()
     await app.state.notifier.close()
+    await app.state.orion.close()
+
+
+async def add_topic_references(
+    conn: asyncpg.Connection, topics: Dict[str, int]
+) -> List[str]:
+    """
+    Add datapoints to the reference counts of their topics and return the topics that did not have any datapoints before,
+    which the gateways have to subscribe to. The rows of the topics stay locked until the end of the transaction, so concurrent
+    requests for the same topic wait for each other and their commands are added to the stream in the order of the changes.
+
+    Args:
+        conn (asyncpg.Connection): The connection to the database, in a transaction.
+        topics (Dict[str, int]): The number of new datapoints of each topic.
+    """
+    # the rows are locked in the order of the topics, so that concurrent requests cannot deadlock
+    ordered = sorted(topics)
+    rows = await conn.fetch(
+        """INSERT INTO topics (topic, datapoints) SELECT * FROM unnest($1::text[], $2::integer[])
+        ON CONFLICT (topic) DO UPDATE SET datapoints = topics.datapoints + EXCLUDED.datapoints
+        RETURNING topic, datapoints""",
+        ordered,
+        [topics[topic] for topic in ordered],
+    )
+    return [row["topic"] for row in rows if row["datapoints"] == topics[row["topic"]]]
+
+
+async def remove_topic_reference(conn: asyncpg.Connection, topic: str) -> bool:
+    """
+    Remove a datapoint from the reference count of its topic and return whether it was the last datapoint of the topic,
+    in which case the gateways have to unsubscribe from it. The row of the topic stays locked until the end of the transaction.
+
+    Args:
+        conn (asyncpg.Connection): The connection to the database, in a transaction.
+        topic (str): The topic of the removed datapoint.
+    """
+    datapoints = await conn.fetchval(
+        """UPDATE topics SET datapoints = datapoints - 1 WHERE topic=$1 RETURNING datapoints""",
+        topic,
+    )
+    if datapoints is not None and datapoints > 0:
+        return False
+    await conn.execute("""DELETE FROM topics WHERE topic=$1""", topic)
+    return True
+
+
+async def send_commands(commands: Dict[str, Iterable[str]]) -> None:
+    """
+    Send commands to the gateways over the manage_topics stream in a single round trip. Each entry of the stream applies
+    an operation (subscribe, unsubscribe or invalidate) to up to CONTROL_BATCH_SIZE topics and carries the next version
+    of the configuration, which lets the gateways detect missed entries and reload their configuration.
+
+    Args:
+        commands (Dict[str, Iterable[str]]): The topics of each operation, in the order the operations are applied.
+    """
+    args = [CONTROL_PROTOCOL_VERSION, STREAM_MAXLEN]
+    for op, topics in commands.items():
+        topics = list(topics)
+        for i in range(0, len(topics), CONTROL_BATCH_SIZE):
+            args += [op, json.dumps(topics[i : i + CONTROL_BATCH_SIZE])]
+    if len(args) > 2:
+        await app.state.send_commands(keys=["manage_topics", "config_version"], args=args)
+
+
+def cache_entry(datapoint: Datapoint) -> str:
+    """
+    Serialize a datapoint as it is stored in the hash of its topic in the redis cache, which is where the gateways look up the datapoints of a topic.
+    """
+    return json.dumps(
+        {
+            "object_id": datapoint.object_id,
+            "jsonpath": datapoint.jsonpath,
+            "entity_id": datapoint.entity_id,
+            "entity_type": datapoint.entity_type,
+            "attribute_name": datapoint.attribute_name,
+            "description": datapoint.description,
+            "coalesce_updates": datapoint.coalesce_updates,
+        }
+    )
 
 
 async def get_connection():
@@ -103,20 +331,275 @@ async def get_connection():
         yield connection
 
 
+def datapoint_page(
+    after: Optional[str] = Query(
+        None, description="Only return datapoints whose object_id comes after this one, i.e. the X-Next-After header of the previous page."
+    ),
+    limit: Optional[int] = Query(
+        None, ge=1, description="The maximum number of datapoints returned, all of them if not set."
+    ),
+    topic_prefix: Optional[str] = Query(
+        None, description="Only return datapoints whose topic starts with this prefix."
+    ),
+    entity_id: Optional[str] = Query(
+        None, description="Only return datapoints of this entity."
+    ),
+    matched: Optional[bool] = Query(
+        None, description="Only return datapoints with (true) or without (false) an entity and attribute."
+    ),
+) -> Dict[str, Any]:
+    """
+    Get the query parameters that select a page of datapoints. Pages are ordered by object_id, so the next page starts after
+    the last object_id of the previous one (keyset pagination) and does not have to skip the rows before it.
+    """
+    return {
+        "after": after,
+        "limit": limit,
+        "topic_prefix": topic_prefix,
+        "entity_id": entity_id,
+        "matched": matched,
+    }
+
+
+def datapoint_query(
+    fields: Iterable[str],
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+    topic_prefix: Optional[str] = None,
+    entity_id: Optional[str] = None,
+    matched: Optional[bool] = None,
+) -> Tuple[str, list]:
+    """
+    Build the query for a page of datapoints and its arguments.
+    """
+    conditions = []
+    args = []
+    if after is not None:
+        args.append(after)
+        conditions.append(f"object_id > ${len(args)}")
+    if topic_prefix is not None:
+        # the prefix is matched literally, so the wildcards of LIKE are escaped
+        args.append(
+            topic_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        )
+        conditions.append(f"topic LIKE ${len(args)}")
+    if entity_id is not None:
+        args.append(entity_id)
+        conditions.append(f"entity_id = ${len(args)}")
+    if matched is not None:
+        conditions.append(
+            ("" if matched else "NOT ")
+            + "(entity_id IS NOT NULL AND attribute_name IS NOT NULL)"
+        )
+    query = f"SELECT {', '.join(DATAPOINT_COLUMNS[field] for field in fields)} FROM datapoints"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY object_id"
+    if limit is not None:
+        args.append(limit)
+        query += f" LIMIT ${len(args)}"
+    return query, args
+
+
+def next_page_headers(rows: List[asyncpg.Record], limit: Optional[int]) -> Dict[str, str]:
+    """
+    Get the X-Next-After header with the cursor of the next page, which is only set if the page is full.
+    """
+    if limit is None or len(rows) < limit:
+        return {}
+    return {"X-Next-After": rows[-1]["object_id"]}
+
+
+async def stream_datapoints(query: str, args: list) -> AsyncIterator[str]:
+    """
+    Stream the datapoints of the query as NDJSON. The rows are read with a cursor, so only STREAM_PREFETCH rows are held at once.
+    The stream has its own connection, since it is still sent after the request handler has returned.
+    """
+    async with app.state.pool.acquire() as connection:
+        async with connection.transaction():
+            lines = []
+            async for row in connection.cursor(query, *args, prefetch=STREAM_PREFETCH):
+                lines.append(json.dumps(dict(row)) + "\n")
+                if len(lines) >= STREAM_PREFETCH:
+                    yield "".join(lines)
+                    lines = []
+            if lines:
+                yield "".join(lines)
+
+
 @app.get(
     "/data",
     response_model=List[Datapoint],
-    summary="Get all datapoints from the gateway",
-    description="Get all datapoints from the gateway. This is to allow the frontend to display all the registered datapoints in the database.",
+    summary="Get the datapoints from the gateway",
+    description="Get the datapoints from the gateway. This is to allow the frontend to display the registered datapoints in the database. \
+                        The datapoints can be filtered and paginated, if a page is full the X-Next-After header is the cursor of the next page. \
+                        With the Accept header application/x-ndjson, the datapoints are streamed with one datapoint per line.",
 )
-async def get_datapoints(conn: asyncpg.Connection = Depends(get_connection)):
+async def get_datapoints(
+    request: Request,
+    page: Dict[str, Any] = Depends(datapoint_page),
+    fields: Optional[str] = Query(
+        None, description="Comma-separated fields of the datapoints to return, the object_id is always included. All fields if not set."
+    ),
+):
     """
-    Get all datapoints from the gateway. This is to allow the frontend to display all the registered datapoints in the database.
+    Get the datapoints from the gateway. This is to allow the frontend to display the registered datapoints in the database.
+    Instead of the whole table, a page of datapoints that match the filters can be fetched, optionally with only some of their fields.
+    The rows are returned without validating them against the model again, they already were validated when they were added.
+
+    Args:
+        request (Request): The request, whose Accept header selects between a JSON array and an NDJSON stream.
+        page (Dict[str, Any]): The filters and the position of the page, see datapoint_page.
+        fields (str, optional): Comma-separated fields of the datapoints to return. Defaults to None which returns all fields.
+
+    Raises:
+        HTTPException: If an unknown field is requested, a 400 error will be raised.
     """
-    rows = await conn.fetch(
-        "SELECT object_id, jsonpath, topic, entity_id, entity_type, attribute_name, description FROM datapoints"
+    selected = ["object_id"]
+    for field in fields.split(",") if fields else DATAPOINT_COLUMNS:
+        field = field.strip()
+        if field not in DATAPOINT_COLUMNS:
+            raise HTTPException(status_code=400, detail=f"Unknown field {field}!")
+        if field not in selected:
+            selected.append(field)
+    query, args = datapoint_query(selected, **page)
+
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_datapoints(query, args), media_type="application/x-ndjson"
+        )
+    async with app.state.pool.acquire() as connection:
+        rows = await connection.fetch(query, *args)
+    return JSONResponse(
+        [dict(row) for row in rows], headers=next_page_headers(rows, page["limit"])
+    )
+
+
+def status_key(row) -> Tuple[str, Optional[str], str]:
+    """
+    Get the entity/attribute pair of a datapoint whose existence in the Context Broker is its match status.
+    """
+    return row["entity_id"], row["entity_type"], row["attribute_name"]
+
+
+async def query_orion(keys: List[Tuple[str, Optional[str], str]]) -> List[dict]:
+    """
+    Query the Context Broker for the entities of the given entity/attribute pairs with a single /v2/op/query request,
+    following the pages of the result if an entity id without a type matches more entities than fit into one page.
+    """
+    entities = {
+        (entity_id, entity_type): {"id": entity_id, "type": entity_type}
+        if entity_type
+        else {"id": entity_id}
+        for entity_id, entity_type, _ in keys
+    }
+    body = {
+        "entities": list(entities.values()),
+        "attrs": sorted({attribute_name for _, _, attribute_name in keys}),
+    }
+    headers = {
+        "fiware-service": FIWARE_SERVICE,
+        "fiware-servicepath": FIWARE_SERVICEPATH,
+    }
+    results = []
+    offset = 0
+    while True:
+        async with app.state.orion.post(
+            f"{ORION_URL}/v2/op/query",
+            params={"options": "keyValues", "limit": ORION_QUERY_SIZE, "offset": offset},
+            json=body,
+            headers=headers,
+        ) as response:
+            response.raise_for_status()
+            page = await response.json()
+        results.extend(page)
+        if len(page) < ORION_QUERY_SIZE:
+            return results
+        offset += ORION_QUERY_SIZE
+
+
+async def match_statuses(
+    keys: Iterable[Tuple[str, Optional[str], str]]
+) -> Dict[Tuple[str, Optional[str], str], bool]:
+    """
+    Check which of the entity/attribute pairs exist in the Context Broker. Instead of one request per pair, the pairs are
+    resolved with one /v2/op/query request per ORION_QUERY_SIZE entities, and the results are cached for STATUS_CACHE_TTL seconds.
+    A pair without an entity type matches an entity of any type.
+
+    Raises:
+        aiohttp.ClientError: If the Context Broker cannot be queried.
+    """
+    now = time.monotonic()
+    statuses = {}
+    missing = []
+    for key in set(keys):
+        entity_id, _, attribute_name = key
+        cached = status_cache.get(key)
+        if entity_id is None or attribute_name is None:
+            statuses[key] = False
+        elif cached is not None and cached[0] > now:
+            statuses[key] = cached[1]
+        else:
+            missing.append(key)
+    if not missing:
+        return statuses
+
+    pages = await asyncio.gather(
+        *(
+            query_orion(missing[i : i + ORION_QUERY_SIZE])
+            for i in range(0, len(missing), ORION_QUERY_SIZE)
+        )
     )
-    return rows
+    found = set()
+    for entities in pages:
+        for entity in entities:
+            for attribute_name in entity:
+                found.add((entity["id"], entity["type"], attribute_name))
+                found.add((entity["id"], None, attribute_name))
+
+    # drop the expired results before adding the new ones, so the cache does not grow without bound
+    for key in [key for key, (expiry, _) in status_cache.items() if expiry <= now]:
+        del status_cache[key]
+    for key in missing:
+        statuses[key] = key in found
+        status_cache[key] = (now + STATUS_CACHE_TTL, statuses[key])
+    return statuses
+
+
+@app.get(
+    "/data/status",
+    response_model=List[DatapointStatus],
+    summary="Get the datapoints together with their match status",
+    description="Get the datapoints together with their match status. This is to allow the frontend to load the table of datapoints in a single request. \
+                        The match status of all datapoints is resolved with a few batched queries to the Context Broker. \
+                        The datapoints can be filtered and paginated as in GET /data.",
+)
+async def get_match_statuses(
+    response: Response,
+    page: Dict[str, Any] = Depends(datapoint_page),
+    conn: asyncpg.Connection = Depends(get_connection),
+):
+    """
+    Get all datapoints together with their match status, i.e. whether their entity/attribute pair exists in the Context Broker.
+    This is to allow the frontend to load the table of datapoints in a single request instead of one status request per datapoint.
+
+    Args:
+        response (Response): The response, whose X-Next-After header is set if the page is full.
+        page (Dict[str, Any]): The filters and the position of the page, see datapoint_page.
+        conn (asyncpg.Connection, optional): The connection to the database. Defaults to Depends(get_connection) which is a connection from the pool of connections to the database.
+
+    Raises:
+        HTTPException: If the Context Broker cannot be queried, a 503 error will be raised.
+    """
+    query, args = datapoint_query(DATAPOINT_COLUMNS, **page)
+    rows = await conn.fetch(query, *args)
+    response.headers.update(next_page_headers(rows, page["limit"]))
+    try:
+        statuses = await match_statuses(status_key(row) for row in rows)
+    except aiohttp.ClientError as e:
+        print(f"Error querying Orion: {e}")
+        raise HTTPException(status_code=503, detail="Context Broker not available!")
+    return [{**dict(row), "status": statuses[status_key(row)]} for row in rows]
 
 
 @app.get(
@@ -187,16 +670,9 @@ async def add_datapoint(
         )
     try:
         async with conn.transaction():
-            # check if there is already a device subscribed to the same topic
-            # if so, the gateway will not subscribe to the topic again
-            subscribed = await conn.fetchrow(
-                """SELECT object_id FROM datapoints WHERE topic=$1 AND object_id!=$2""",
-                datapoint.topic,
-                datapoint.object_id,
-            )
             await conn.execute(
-                """INSERT INTO datapoints (object_id, jsonpath, topic, entity_id, entity_type, attribute_name, description) 
-                VALUES ($1, $2, $3, $4, $5, $6, $7)""",
+                """INSERT INTO datapoints (object_id, jsonpath, topic, entity_id, entity_type, attribute_name, description, coalesce_updates) 
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)""",
                 datapoint.object_id,
                 datapoint.jsonpath,
                 datapoint.topic,
@@ -204,39 +680,151 @@ async def add_datapoint(
                 datapoint.entity_type,
                 datapoint.attribute_name,
                 datapoint.description,
+                datapoint.coalesce_updates,
             )
+            # the gateways only subscribe to the topic if this is its first datapoint
+            subscribe = bool(await add_topic_references(conn, {datapoint.topic: 1}))
 
-        # store the jsonpath and topic in redis for easy retrieval later
-        await app.state.redis.set(
-            datapoint.object_id,
-            json.dumps({"jsonpath": datapoint.jsonpath, "topic": datapoint.topic}),
-        )
+            # the cache and the gateways are updated before the transaction is committed, while the topic is still locked,
+            # so that the command of a concurrent request for the same topic cannot overtake this one
+            # store the jsonpath and topic in redis for easy retrieval later
+            await app.state.redis.set(
+                datapoint.object_id,
+                json.dumps({"jsonpath": datapoint.jsonpath, "topic": datapoint.topic}),
+            )
 
-        await app.state.redis.hset(
-            datapoint.topic,
-            datapoint.object_id,
-            json.dumps(
-                {
-                    "object_id": datapoint.object_id,
-                    "jsonpath": datapoint.jsonpath,
-                    "entity_id": datapoint.entity_id,
-                    "entity_type": datapoint.entity_type,
-                    "attribute_name": datapoint.attribute_name,
-                    "description": datapoint.description,
-                }
-            ),
-        )
+            await app.state.redis.hset(
+                datapoint.topic, datapoint.object_id, cache_entry(datapoint)
+            )
+
+            # notify the gateways that a new datapoint has been added
+            # if the topic is already subscribed to, the gateways only need to reload its datapoints
+            await send_commands({"subscribe" if subscribe else "invalidate": [datapoint.topic]})
 
-        # publish a notification to the database to notify that a new datapoint has been added
-        if not subscribed:
-            stream_name = "manage_topics"
-            await app.state.notifier.xadd(
-                    stream_name,
-                    {'subscribe': datapoint.topic},
+        return {**datapoint.dict(), "subscribe": subscribe}
+
+    except asyncpg.exceptions.UniqueViolationError:
+        raise HTTPException(status_code=409, detail="Device already exists!")
+
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail="Internal Server Error!")
+
+
+async def read_datapoints(request: Request) -> List[Datapoint]:
+    """
+    Read the datapoints of a bulk request. The body is either a JSON array of datapoints or, with the content type
+    application/x-ndjson, one datapoint per line. NDJSON is parsed while it is received, so the raw body is never held at once.
+
+    Raises:
+        HTTPException: If the body is not valid JSON, a 400 error will be raised. If a datapoint is invalid, a 422 error will be raised.
+    """
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            items = []
+            rest = b""
+            async for chunk in request.stream():
+                lines = (rest + chunk).split(b"\n")
+                rest = lines.pop()
+                items.extend(json.loads(line) for line in lines if line.strip())
+            if rest.strip():
+                items.append(json.loads(rest))
+        else:
+            items = await request.json()
+        return parse_obj_as(List[Datapoint], items)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+
+
+@app.post(
+    "/data/bulk",
+    response_model=List[Datapoint],
+    status_code=201,
+    summary="Add many datapoints to the gateway at once",
+    description="Add many datapoints to the gateway at once, e.g. to provision a large number of devices. The body is either a JSON array of datapoints \
+                       or NDJSON (application/x-ndjson) with one datapoint per line. All datapoints are inserted in a single transaction, \
+                       so either all or none of them are added. The gateways are notified once per distinct topic.",
+)
+async def add_datapoints(
+    request: Request, conn: asyncpg.Connection = Depends(get_connection)
+):
+    """
+    Add many datapoints to the gateway at once. Instead of one round trip per datapoint and statement, the datapoints are
+    copied into the database in a single transaction, the redis writes are pipelined and the gateways are notified
+    once per distinct topic: topics that did not have any datapoints are subscribed to, the others are only reloaded.
+
+    Args:
+        request (Request): The request whose body contains the datapoints, either as a JSON array or as NDJSON.
+        conn (asyncpg.Connection, optional): The connection to the database. Defaults to Depends(get_connection) which is a connection from the pool of connections to the database.
+
+    Raises:
+        HTTPException: If a datapoint is supposed to be matched but the corresponding information is not provided, a 400 error will be raised.
+        UniqueViolationError: If the object_id of a datapoint already exists in the database, a 409 error will be raised.
+        Exception: If some other error occurs, a 500 error will be raised.
+    """
+    datapoints = await read_datapoints(request)
+    for i, datapoint in enumerate(datapoints):
+        datapoint.object_id = str(uuid4())
+        if datapoint.matchDatapoint and (
+            datapoint.entity_id is None or datapoint.attribute_name is None
+        ):
+            raise HTTPException(
+                status_code=400,
+                detail=f"entity_id and attribute_name must be set if Match Datapoint is enabled (datapoint {i})!",
+            )
+    topics = [datapoint.topic for datapoint in datapoints]
+    try:
+        async with conn.transaction():
+            await conn.copy_records_to_table(
+                "datapoints",
+                records=[
+                    (
+                        datapoint.object_id,
+                        datapoint.jsonpath,
+                        datapoint.topic,
+                        datapoint.entity_id,
+                        datapoint.entity_type,
+                        datapoint.attribute_name,
+                        datapoint.description,
+                        datapoint.coalesce_updates,
+                    )
+                    for datapoint in datapoints
+                ],
+                columns=[
+                    "object_id",
+                    "jsonpath",
+                    "topic",
+                    "entity_id",
+                    "entity_type",
+                    "attribute_name",
+                    "description",
+                    "coalesce_updates",
+                ],
+            )
+            # topics that already had datapoints are subscribed to by the gateways
+            subscribe = set(await add_topic_references(conn, Counter(topics)))
+
+            # as for a single datapoint, the cache and the gateways are updated while the topics are locked
+            # the commands are sent in one round trip instead of one per command
+            pipeline = app.state.redis.pipeline(transaction=False)
+            for datapoint in datapoints:
+                pipeline.set(
+                    datapoint.object_id,
+                    json.dumps({"jsonpath": datapoint.jsonpath, "topic": datapoint.topic}),
                 )
+                pipeline.hset(datapoint.topic, datapoint.object_id, cache_entry(datapoint))
+            await pipeline.execute()
 
+            await send_commands(
+                {
+                    "subscribe": subscribe,
+                    "invalidate": set(topics) - subscribe,
+                }
+            )
 
-        return {**datapoint.dict(), "subscribe": subscribed is None}
+        return datapoints
 
     except asyncpg.exceptions.UniqueViolationError:
         raise HTTPException(status_code=409, detail="Device already exists!")
@@ -270,11 +858,12 @@ async def update_datapoint(
     """
     async with conn.transaction():
         await conn.execute(
-            """UPDATE datapoints SET entity_id=$1, entity_type=$2, attribute_name=$3, description=$4 WHERE object_id=$5""",
+            """UPDATE datapoints SET entity_id=$1, entity_type=$2, attribute_name=$3, description=$4, coalesce_updates=$5 WHERE object_id=$6""",
             datapoint.entity_id,
             datapoint.entity_type,
             datapoint.attribute_name,
             datapoint.description,
+            datapoint.coalesce_updates,
             object_id,
         )
 
@@ -292,9 +881,12 @@ async def update_datapoint(
                 "entity_type": datapoint.entity_type,
                 "attribute_name": datapoint.attribute_name,
                 "description": datapoint.description,
+                "coalesce_updates": datapoint.coalesce_updates,
             }
         ),
     )
+    # notify the gateways that the datapoints of the topic have changed
+    await send_commands({"invalidate": [topic]})
 
     return {**datapoint.dict()}
 
@@ -316,31 +908,31 @@ async def delete_datapoint(
         conn (asyncpg.Connection, optional): The connection to the database. Defaults to Depends(get_connection) which is a connection from the pool of connections to the database.
 
     Raises:
+        HTTPException: If the datapoint is not found, a 404 error will be raised.
         Exception: If some error occurs, a 500 error will be raised.
     """
     try:
         async with conn.transaction():
             datapoint = await conn.fetchrow(
-                """SELECT jsonpath, topic, entity_id, entity_type, attribute_name FROM datapoints WHERE object_id=$1""",
-                object_id,
-            )
-            # check if the topic is the last subscriber
-            # if so, the gateway will unsubscribe from the topic
-            unsubscribe = await conn.fetchrow(
-                """SELECT object_id FROM datapoints WHERE topic=$1 AND object_id!=$2""",
-                datapoint["topic"],
+                """DELETE FROM datapoints WHERE object_id=$1 RETURNING topic""",
                 object_id,
             )
-            await conn.execute(
-                """DELETE FROM datapoints WHERE object_id=$1""", object_id
-            )
+            if datapoint is None:
+                raise HTTPException(status_code=404, detail="Datapoint not found!")
+            # the gateways unsubscribe from the topic if this was its last datapoint
+            unsubscribe = await remove_topic_reference(conn, datapoint["topic"])
 
-        await app.state.redis.delete(object_id)
-        await app.state.redis.hdel(datapoint["topic"], object_id)
+            # as when adding a datapoint, the cache and the gateways are updated while the topic is locked
+            await app.state.redis.delete(object_id)
+            await app.state.redis.hdel(datapoint["topic"], object_id)
 
-        if not unsubscribe:
-            await app.state.notifier.publish("unsubscribe", datapoint["topic"])
+            # notify the gateways that the datapoints of the topic have changed
+            await send_commands(
+                {"unsubscribe" if unsubscribe else "invalidate": [datapoint["topic"]]}
+            )
         return None
+    except HTTPException:
+        raise
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Internal Server Error!")
@@ -364,26 +956,19 @@ async def delete_all_datapoints(conn: asyncpg.Connection = Depends(get_connectio
     """
     try:
         async with conn.transaction():
-            datapoints = await conn.fetch(
-                """SELECT object_id, jsonpath, topic, entity_id, entity_type, attribute_name FROM datapoints"""
-            )
-            await conn.execute("""DELETE FROM datapoints""")
-        for datapoint in datapoints:
-            await app.state.redis.delete(datapoint["object_id"])
-            await app.state.notifier.publish(
-                "delete_datapoint",
-                json.dumps(
-                    {
-                        "object_id": datapoint["object_id"],
-                        "jsonpath": datapoint["jsonpath"],
-                        "topic": datapoint["topic"],
-                        "entity_id": datapoint["entity_id"],
-                        "entity_type": datapoint["entity_type"],
-                        "attribute_name": datapoint["attribute_name"],
-                        "unsubscribe": True,
-                    }
-                ),
-            )
+            datapoints = await conn.fetch("""DELETE FROM datapoints RETURNING object_id""")
+            topics = await conn.fetch("""DELETE FROM topics RETURNING topic""")
+
+            # as when adding a datapoint, the cache and the gateways are updated while the topics are locked
+            # drop the datapoints and the topics from the cache and let the gateways unsubscribe from all topics
+            keys = [datapoint["object_id"] for datapoint in datapoints] + [
+                row["topic"] for row in topics
+            ]
+            pipeline = app.state.redis.pipeline(transaction=False)
+            for i in range(0, len(keys), CONTROL_BATCH_SIZE):
+                pipeline.delete(*keys[i : i + CONTROL_BATCH_SIZE])
+            await pipeline.execute()
+            await send_commands({"unsubscribe": [row["topic"] for row in topics]})
         return None
     except Exception as e:
         print(e)
@@ -407,7 +992,7 @@ async def get_match_status(
         conn (asyncpg.Connection, optional): The connection to the database. Defaults to Depends(get_connection) which is a connection from the pool of connections to the database.
 
     Raises:
-        HTTPException: If the datapoint is not found in the Context Broker, a 404 error will be raised.
+        HTTPException: If the datapoint is not found, a 404 error will be raised. If the Context Broker cannot be queried, a 503 error will be raised.
 
     Returns:
         bool: True if the datapoint is matched to an existing entity/attribute pair in the Context Broker, False otherwise.
@@ -419,11 +1004,12 @@ async def get_match_status(
     if row is None:
         raise HTTPException(status_code=404, detail="Datapoint not found!")
 
-    async with aiohttp.ClientSession() as session:
-        response = await session.get(
-            f"{ORION_URL}/v2/entities/{row['entity_id']}/attrs/{row['attribute_name']}/?type={row['entity_type']}"
-        )
-        return response.status == 200
+    try:
+        statuses = await match_statuses([status_key(row)])
+    except aiohttp.ClientError as e:
+        print(f"Error querying Orion: {e}")
+        raise HTTPException(status_code=503, detail="Context Broker not available!")
+    return statuses[status_key(row)]
 
 @app.get("/system/status",
     response_model=dict,
@@ -0,0 +1,88 @@
+"""
+This module implements the coordination of topic ownership between several gateway replicas.
+"""
+
+import bisect
+import hashlib
+import time
+from typing import Iterable, List
+
+from redis import asyncio as aioredis
+
+
+def _hash(key: str) -> int:
+    # A stable hash, Python's hash() differs between processes
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring that assigns every topic to exactly one gateway.
+    When a gateway joins or leaves, only the topics of its neighbours on the ring move.
+    """
+
+    def __init__(self, members: Iterable[str], replicas: int = 64):
+        """
+        Args:
+            members (Iterable[str]): The ids of the live gateways.
+            replicas (int, optional): The number of points per gateway on the ring. Defaults to 64.
+        """
+        self.members = sorted(set(members))
+        points = sorted(
+            (_hash(f"{member}#{i}"), member)
+            for member in self.members
+            for i in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, topic: str) -> str:
+        """
+        Returns the id of the gateway that owns the topic.
+        """
+        index = bisect.bisect(self._hashes, _hash(topic)) % len(self._hashes)
+        return self._owners[index]
+
+
+class ClusterMembership:
+    """
+    Keeps track of the live gateways in a Redis sorted set scored by the time of their last heartbeat.
+    A gateway that has not sent a heartbeat within the timeout is considered dead and removed from the set.
+    """
+
+    def __init__(
+        self,
+        redis: aioredis.Redis,
+        member_id: str,
+        key: str = "gateway_members",
+        timeout: float = 10,
+    ):
+        """
+        Args:
+            redis (aioredis.Redis): The Redis connection.
+            member_id (str): The id of this gateway.
+            key (str, optional): The key of the sorted set. Defaults to "gateway_members".
+            timeout (float, optional): The time in seconds after which a silent gateway is considered dead. Defaults to 10.
+        """
+        self.redis = redis
+        self.member_id = member_id
+        self.key = key
+        self.timeout = timeout
+
+    async def heartbeat(self) -> List[str]:
+        """
+        Announces that this gateway is alive, removes dead gateways and returns the ids of all live gateways.
+        """
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.key, {self.member_id: now})
+            pipe.zremrangebyscore(self.key, "-inf", now - self.timeout)
+            pipe.zrange(self.key, 0, -1)
+            *_, members = await pipe.execute()
+        return [member.decode() for member in members]
+
+    async def leave(self) -> None:
+        """
+        Removes this gateway from the cluster, so its topics are taken over without waiting for the timeout.
+        """
+        await self.redis.zrem(self.key, self.member_id)
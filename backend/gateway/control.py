@@ -0,0 +1,46 @@
+"""
+This module implements the control protocol of the manage_topics stream, over which the API tells the gateways
+which topics to subscribe to and whose datapoints have changed.
+
+An entry of version 2 has the fields version, config_version, op and topics, where op is one of OPERATIONS and topics
+is a JSON array of the topics the operation applies to. The config version is incremented by one with every entry, so a
+gateway that sees it jump has missed changes and reloads its configuration. Entries of version 1 have no config version.
+Entries without a version field are single commands of earlier versions of the API, with a single field whose name is
+the operation and whose value is the topic.
+"""
+
+import json
+from typing import Dict, List, Optional, Tuple
+
+VERSION = 2
+OPERATIONS = ("subscribe", "unsubscribe", "invalidate")
+
+
+def parse_entry(fields: Dict[bytes, bytes]) -> Tuple[Optional[int], List[Tuple[str, str]]]:
+    """
+    Returns the config version of an entry of the manage_topics stream, None for entries of earlier versions without one,
+    and its (operation, topic) pairs in the order they have to be applied.
+
+    Raises:
+        ValueError: If the entry has an unknown version or is malformed.
+    """
+    decoded = {key.decode(): value.decode() for key, value in fields.items()}
+    version = decoded.get("version")
+    if version is None:
+        if len(decoded) != 1:
+            raise ValueError(f"Expected a single command, got {sorted(decoded)}")
+        return None, list(decoded.items())
+    if version not in ("1", str(VERSION)):
+        raise ValueError(f"Unknown protocol version {version}")
+    op = decoded.get("op")
+    if op not in OPERATIONS:
+        raise ValueError(f"Unknown operation {op}")
+    config_version = None
+    if version != "1":
+        if not decoded.get("config_version", "").isdigit():
+            raise ValueError("Expected a config version")
+        config_version = int(decoded["config_version"])
+    topics = json.loads(decoded.get("topics", "[]"))
+    if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+        raise ValueError("Expected a JSON array of topics")
+    return config_version, [(op, topic) for topic in topics]
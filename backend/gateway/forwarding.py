@@ -0,0 +1,552 @@
+"""
+This module implements the forwarding of attribute updates to the Orion Context Broker.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+
+from metrics import (
+    DEAD_LETTERS,
+    ORION_ENTITIES,
+    ORION_REQUESTS,
+    SPOOLED,
+)
+from spool import Spool
+from tracing import Trace, Tracer
+
+EntityKey = Tuple[str, Optional[str]]  # (entity_id, entity_type)
+
+
+class OrionError(Exception):
+    """
+    Raised when Orion does not acknowledge an update.
+    Only errors that may go away on their own (connection errors, 5xx, 429) are retried.
+    """
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to Orion after a number of consecutive failures.
+    Once the reset timeout has elapsed, a single trial request is let through. If it succeeds, the breaker closes again,
+    otherwise it stays open for another timeout.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10):
+        """
+        Args:
+            failure_threshold (int, optional): The number of consecutive failures that open the breaker. Defaults to 5.
+            reset_timeout (float, optional): The time in seconds before a trial request is let through. Defaults to 10.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False  # Whether a trial request is in flight
+
+    @property
+    def closed(self) -> bool:
+        return self.opened_at is None
+
+    def ready(self) -> bool:
+        """
+        Returns whether the breaker is closed or a trial request is due.
+        """
+        return self.closed or (
+            not self._trial and time.monotonic() - self.opened_at >= self.reset_timeout
+        )
+
+    def allow(self) -> bool:
+        """
+        Returns whether a request may be sent.
+        """
+        if self.closed:
+            return True
+        if self._trial or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self._trial = True
+        return True
+
+    def record_success(self) -> bool:
+        """
+        Records a successful request. Returns True if this closed the breaker.
+        """
+        recovered = not self.closed
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        return recovered
+
+    def record_failure(self) -> None:
+        """
+        Records a failed request and opens the breaker once the threshold is reached.
+        """
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+
+class DeadLetterStore:
+    """
+    Append-only file of updates that could not be delivered to Orion, one JSON record per line.
+    Records of updates that failed because Orion was unavailable are replayed in bulk once it has recovered.
+    Records of updates that Orion rejected are kept for inspection but not replayed.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The path of the dead-letter file.
+        """
+        self.path = path
+        self.replay_path = f"{path}.replay"  # Records taken for a replay that has not finished yet
+        self._lock = asyncio.Lock()
+
+    async def append(self, entities: List[Dict[str, Any]], reason: str, created: float) -> None:
+        """
+        Appends the entities of a failed update to the store.
+
+        Args:
+            entities (List[Dict[str, Any]]): The entities in NGSI v2 format.
+            reason (str): Either "unavailable" or "rejected".
+            created (float): The time the update was flushed by the batcher.
+        """
+        line = json.dumps({"time": created, "reason": reason, "entities": entities})
+        async with self._lock:
+            await asyncio.to_thread(self._write, line)
+
+    def _write(self, line: str) -> None:
+        with open(self.path, "a") as file:
+            file.write(line + "\n")
+
+    def pending(self) -> bool:
+        """
+        Returns whether there are records to replay.
+        """
+        return os.path.exists(self.path) or os.path.exists(self.replay_path)
+
+    async def take(self) -> List[Dict[str, Any]]:
+        """
+        Takes all records out of the store for a replay. Records of a replay that was interrupted are returned again.
+        """
+        async with self._lock:
+            return await asyncio.to_thread(self._take)
+
+    def _take(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.replay_path):
+            if not os.path.exists(self.path):
+                return []
+            os.replace(self.path, self.replay_path)
+        records = []
+        with open(self.replay_path) as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # A partially written line
+        return records
+
+    async def commit(self) -> None:
+        """
+        Removes the records of a finished replay.
+        """
+        async with self._lock:
+            await asyncio.to_thread(os.remove, self.replay_path)
+
+
+class OrionBatcher:
+    """
+    Collects attribute updates over a short window and sends them to the Orion Context Broker
+    as a single /v2/op/update request. Updates to the same entity are merged into one entity.
+    A batch is flushed when the window has elapsed or when it contains the maximum number of entities.
+    If an attribute is updated again while its previous value is still pending, the pending batch is
+    flushed first, so no value is lost. For coalesced datapoints, the pending value is replaced by the
+    newer one instead, so only the last value of a burst is sent.
+
+    Flushed batches are sent in the background with up to max_in_flight requests at a time, so the workers
+    do not wait for Orion. A batch that contains an entity of a batch still in flight is only sent once
+    the earlier batch has been acknowledged, so updates to the same attribute never arrive reversed.
+
+    Failed requests are retried with exponential backoff and jitter. Updates that cannot be delivered, because
+    the retries are exhausted or the circuit breaker around Orion is open, go to the dead-letter store and are
+    replayed once Orion has recovered. Replays go through the same ordering as new batches, and attributes that
+    have been sent again since the failed update are left out, so a replay never overwrites a newer value.
+    If a spool is configured, it takes the place of the dead-letter store for updates that failed because Orion
+    was unavailable, and new batches are spooled right away while the circuit breaker is open.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        logger: logging.Logger,
+        window: float = 0.01,
+        max_entities: int = 100,
+        max_in_flight: int = 8,
+        max_retries: int = 5,
+        retry_base_delay: float = 0.1,
+        retry_max_delay: float = 5,
+        breaker: Optional[CircuitBreaker] = None,
+        dead_letters: Optional[DeadLetterStore] = None,
+        spool: Optional[Spool] = None,
+        tracer: Optional[Tracer] = None,
+    ):
+        """
+        Args:
+            url (str): The URL of the Orion Context Broker.
+            headers (Dict[str, str]): The FIWARE headers sent with every request.
+            logger (logging.Logger): The logger of the gateway.
+            window (float, optional): The time in seconds updates are collected before they are sent. Defaults to 0.01.
+            max_entities (int, optional): The maximum number of entities in a single request. Defaults to 100.
+            max_in_flight (int, optional): The maximum number of concurrent requests to Orion. Defaults to 8.
+            max_retries (int, optional): The number of retries of a failed request. Defaults to 5.
+            retry_base_delay (float, optional): The delay in seconds before the first retry. Defaults to 0.1.
+            retry_max_delay (float, optional): The maximum delay in seconds between two retries. Defaults to 5.
+            breaker (CircuitBreaker, optional): The circuit breaker around Orion. Defaults to a new breaker.
+            dead_letters (DeadLetterStore, optional): Where undeliverable updates go. Defaults to None, which drops them.
+            spool (Spool, optional): Buffers updates on disk while Orion is unavailable. Defaults to None.
+            tracer (Tracer, optional): Finishes the traces of the messages once their batches are done. Defaults to None.
+        """
+        self.url = f"{url}/v2/op/update"
+        self.headers = headers
+        self.logger = logger
+        self.window = window
+        self.max_entities = max_entities
+        self.session: Optional[aiohttp.ClientSession] = None  # Initialized in run()
+        self._pending: Dict[EntityKey, Dict[str, Any]] = {}
+        self._pending_traces: Set[Trace] = set()  # Traces of the messages in the pending batch
+        self._has_pending = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_in_flight)  # Bounds the requests in flight
+        self._in_flight: Dict[EntityKey, asyncio.Future] = {}  # Last batch in flight per entity
+        self._tasks = set()  # Keeps a reference to the running dispatch tasks
+        # Time of the last flushed batch per attribute, to recognize replayed values that have been superseded.
+        # Holds one entry per attribute of the configured datapoints.
+        self._sent: Dict[Tuple[EntityKey, str], float] = {}
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.dead_letters = dead_letters
+        self.spool = spool
+        self.tracer = tracer
+        self._replaying = False
+
+    async def submit(
+        self,
+        entity_id: str,
+        entity_type: Optional[str],
+        attribute_name: str,
+        value: Any,
+        coalesce: bool = False,
+        trace: Optional[Trace] = None,
+    ) -> None:
+        """
+        Adds an attribute update to the pending batch.
+
+        Args:
+            entity_id (str): The id of the entity.
+            entity_type (Optional[str]): The type of the entity.
+            attribute_name (str): The name of the attribute.
+            value (Any): The new value of the attribute.
+            coalesce (bool, optional): Whether a pending value of the attribute may be superseded. Defaults to False.
+            trace (Trace, optional): The trace of the message the value was extracted from. Defaults to None.
+        """
+        key = (entity_id, entity_type)
+        # Other workers may add to the pending batch while a flush waits for a slot, so the conditions are
+        # checked again after every flush
+        while True:
+            attrs = self._pending.get(key)
+            if attrs is None and len(self._pending) >= self.max_entities:
+                await self.flush()
+            elif attrs is not None and attribute_name in attrs and not coalesce:
+                # Do not overwrite a value that has not been sent yet
+                await self.flush()
+            else:
+                break
+        attrs = self._pending.setdefault(key, {})
+
+        attrs[attribute_name] = {"type": "Number", "value": value}
+        if trace is not None and trace not in self._pending_traces:
+            trace.pending += 1
+            self._pending_traces.add(trace)
+        self._has_pending.set()
+
+    async def flush(self) -> None:
+        """
+        Dispatches all pending updates as a single request.
+        Only waits if the maximum number of requests is already in flight.
+        """
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        traces, self._pending_traces = self._pending_traces, set()
+        self._has_pending.clear()
+        created = time.time()
+
+        entities = []
+        for (entity_id, entity_type), attrs in batch.items():
+            entity = {"id": entity_id}
+            if entity_type:
+                entity["type"] = entity_type
+            entity.update(attrs)
+            entities.append(entity)
+            for name in attrs:
+                self._sent[(entity_id, entity_type), name] = created
+
+        if self.spool is not None and not self.breaker.closed:
+            # Orion is down, keep the batch on disk until it has recovered
+            self.spool.append({"kind": "update", "time": created, "entities": entities})
+            SPOOLED.labels("update").inc()
+            self.finish(traces)
+            return
+
+        await self.enqueue(entities, list(batch), traces, created)
+
+    async def resend(self, entities: List[Dict[str, Any]], created: float) -> Optional[asyncio.Future]:
+        """
+        Dispatches an update that failed earlier, like a newly flushed batch. Attributes that have been flushed
+        again since the update was created are left out, so their newer values are not overwritten.
+
+        Args:
+            entities (List[Dict[str, Any]]): The entities in NGSI v2 format.
+            created (float): The time the update was flushed.
+
+        Returns:
+            Optional[asyncio.Future]: Resolved once the update is done, None if all of it has been superseded.
+        """
+        remaining, keys = [], []
+        for entity in entities:
+            key = (entity["id"], entity.get("type"))
+            current = {
+                name: attr
+                for name, attr in entity.items()
+                if name in ("id", "type") or self._sent.get((key, name), 0) <= created
+            }
+            if len(current) > len(entity.keys() & {"id", "type"}):
+                remaining.append(current)
+                keys.append(key)
+        if not remaining:
+            return None
+        return await self.enqueue(remaining, keys, set(), created)
+
+    async def enqueue(
+        self,
+        entities: List[Dict[str, Any]],
+        keys: List[EntityKey],
+        traces: Set[Trace],
+        created: float,
+    ) -> asyncio.Future:
+        """
+        Starts dispatching a batch after the batches in flight that share an entity with it.
+        Only waits if the maximum number of requests is already in flight.
+
+        Returns:
+            asyncio.Future: Resolved once the batch is done.
+        """
+        # Earlier batches with the same entities have to be acknowledged first
+        previous = {self._in_flight[key] for key in keys if key in self._in_flight}
+        done = asyncio.get_running_loop().create_future()
+        for key in keys:
+            self._in_flight[key] = done
+
+        await self._slots.acquire()
+        task = asyncio.create_task(
+            self.dispatch(entities, keys, previous, done, traces, created)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return done
+
+    async def dispatch(
+        self,
+        entities: List[Dict[str, Any]],
+        keys: List[EntityKey],
+        previous: Set[asyncio.Future],
+        done: asyncio.Future,
+        traces: Set[Trace],
+        created: float,
+    ) -> None:
+        """
+        Sends a batch once the batches it depends on have been acknowledged and frees its slot afterwards.
+
+        Args:
+            entities (List[Dict[str, Any]]): The entities in NGSI v2 format.
+            keys (List[EntityKey]): The keys of the entities.
+            previous (Set[asyncio.Future]): The batches in flight that share an entity with this batch.
+            done (asyncio.Future): Resolved once this batch has been acknowledged.
+            traces (Set[Trace]): The traces of the messages in the batch.
+            created (float): The time the batch was flushed.
+        """
+        try:
+            if previous:
+                await asyncio.wait(previous)
+            for trace in traces:
+                trace.mark("sent")
+            if await self.deliver(entities, created):
+                for trace in traces:
+                    trace.mark("acknowledged")
+        finally:
+            self.finish(traces)
+            done.set_result(None)
+            for key in keys:
+                if self._in_flight.get(key) is done:
+                    del self._in_flight[key]
+            self._slots.release()
+
+    async def deliver(self, entities: List[Dict[str, Any]], created: float) -> bool:
+        """
+        Sends the entities to Orion, retrying with exponential backoff and jitter.
+        Updates that cannot be delivered are written to the dead-letter store.
+
+        Args:
+            entities (List[Dict[str, Any]]): The entities in NGSI v2 format.
+            created (float): The time the update was flushed.
+
+        Returns:
+            bool: Whether Orion has acknowledged the update.
+        """
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                break
+            try:
+                await self.send(entities)
+            except OrionError as e:
+                if not e.retryable:
+                    # Orion answered, it just did not like the update
+                    self.recovered()
+                    self.logger.error("%s", e)
+                    await self.dead_letter(entities, "rejected", created)
+                    return False
+                self.breaker.record_failure()
+                self.logger.warning("%s (attempt %d)", e, attempt + 1)
+                if attempt < self.max_retries:
+                    delay = min(self.retry_max_delay, self.retry_base_delay * 2**attempt)
+                    await asyncio.sleep(random.uniform(0, delay))
+            else:
+                self.recovered()
+                return True
+
+        await self.dead_letter(entities, "unavailable", created)
+        return False
+
+    def finish(self, traces: Set[Trace]) -> None:
+        """
+        Releases the hold of a batch that is done on the traces of its messages.
+        """
+        if self.tracer is None:
+            return
+        for trace in traces:
+            self.tracer.release(trace)
+
+    def recovered(self) -> None:
+        """
+        Records that Orion has answered and replays the dead-letter store if the breaker was open.
+        """
+        if self.breaker.record_success():
+            self.logger.info("Orion Context Broker has recovered")
+            self.replay()
+
+    async def dead_letter(self, entities: List[Dict[str, Any]], reason: str, created: float) -> None:
+        """
+        Writes the entities of an undeliverable update to the dead-letter store.
+        """
+        if self.spool is not None and reason == "unavailable":
+            self.spool.append({"kind": "update", "time": created, "entities": entities})
+            SPOOLED.labels("update").inc()
+            return
+        if self.dead_letters is None:
+            self.logger.error("Dropped update of %d entities (%s)", len(entities), reason)
+            return
+        await self.dead_letters.append(entities, reason, created)
+        DEAD_LETTERS.labels(reason).inc()
+
+    def replay(self) -> None:
+        """
+        Starts replaying the dead-letter store in the background, unless a replay is already running.
+        """
+        if self._replaying or self.dead_letters is None or not self.dead_letters.pending():
+            return
+        self._replaying = True
+        task = asyncio.create_task(self.replay_dead_letters())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def replay_dead_letters(self) -> None:
+        """
+        Sends all records of the dead-letter store that failed because Orion was unavailable.
+        Updates that fail again go back to the store, as do the records of rejected updates.
+        The records are only removed once all replayed updates are done.
+        """
+        try:
+            records = await self.dead_letters.take()
+            self.logger.info("Replaying %d dead-lettered updates", len(records))
+            replayed = []
+            for record in records:
+                if record["reason"] == "unavailable":
+                    done = await self.resend(record["entities"], record["time"])
+                    if done is not None:
+                        replayed.append(done)
+                else:
+                    await self.dead_letters.append(record["entities"], record["reason"], record["time"])
+            if replayed:
+                await asyncio.wait(replayed)
+            await self.dead_letters.commit()
+        except Exception as e:
+            self.logger.error("Replay of dead-lettered updates failed: %s", e)
+        finally:
+            self._replaying = False
+
+    async def send(self, entities: List[Dict[str, Any]]) -> None:
+        """
+        Appends the attributes of the given entities in the Orion Context Broker.
+
+        Args:
+            entities (List[Dict[str, Any]]): The entities in NGSI v2 format.
+
+        Raises:
+            OrionError: If Orion does not acknowledge the update.
+        """
+        start = time.perf_counter()
+        try:
+            async with self.session.post(
+                url=self.url,
+                json={"actionType": "append", "entities": entities},
+                headers=self.headers,
+            ) as response:
+                if response.status >= 300:
+                    retryable = response.status >= 500 or response.status == 429
+                    ORION_REQUESTS.labels(
+                        "unavailable" if retryable else "rejected"
+                    ).observe(time.perf_counter() - start)
+                    raise OrionError(
+                        f"Orion rejected update of {len(entities)} entities: {response.status} {await response.text()}",
+                        retryable=retryable,
+                    )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            ORION_REQUESTS.labels("unavailable").observe(time.perf_counter() - start)
+            raise OrionError(f"Orion is unavailable: {e!r}")
+        ORION_REQUESTS.labels("success").observe(time.perf_counter() - start)
+        ORION_ENTITIES.inc(len(entities))
+        self.logger.debug("Sent %d entities to Orion Context Broker", len(entities))
+
+    async def run(self) -> None:
+        """
+        Flushes the pending batch once the window has elapsed. Runs until cancelled.
+        """
+        async with aiohttp.ClientSession() as self.session:
+            self.replay()  # Updates left over from the last run
+            while True:
+                await self._has_pending.wait()
+                await asyncio.sleep(self.window)
+                await self.flush()
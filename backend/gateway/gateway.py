@@ -3,20 +3,52 @@ This module implements the MQTT IoT Gateway.
 """
 
 import asyncio
+import base64
 import json
+import logging
+import multiprocessing
+import multiprocessing.connection
 import os
-from typing import List, Tuple
+import signal
+import socket
+import sys
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-import aiohttp
-import async_timeout
 import asyncpg
-from aiologger import Logger
-from aiologger.handlers.files import AsyncFileHandler
-from asyncio_mqtt import Client, MqttError
+from asyncio_mqtt import Client, MqttError, ProtocolVersion
 from filip.models.base import FiwareHeader
-from jsonpath_ng import parse
+from prometheus_client import start_http_server
 from redis import asyncio as aioredis
-from uuid import uuid4
+from redis.exceptions import RedisError
+
+from cluster import ClusterMembership, HashRing
+from control import parse_entry
+from forwarding import CircuitBreaker, DeadLetterStore, OrionBatcher
+from logs import setup_logging
+from metrics import (
+    CONFIG_RESYNCS,
+    CONFIG_VERSION,
+    ERRORS,
+    MESSAGES_FORWARDED,
+    MESSAGES_RECEIVED,
+    ORION_BREAKER_OPEN,
+    POSTGRES_FALLBACKS,
+    QUEUE_DEPTH,
+    REDIS_CACHE,
+    ROUTE_CACHE,
+    SPOOLED,
+    SUBSCRIPTIONS,
+    WORKER_BUSY_SECONDS,
+    WORKERS,
+    WORKERS_BUSY,
+    topic_label,
+)
+from queues import BLOCK, ClientBufferDrops, MessageQueue
+from routing import Route, RoutingTable, is_coalesced
+from spool import Spool
+from topics import SubscriptionPlan, TopicTrie, is_wildcard
+from tracing import Trace, Tracer
 
 # Load configuration from JSON file
 MQTT_HOST = os.environ.get("MQTT_HOST", "localhost")
@@ -33,6 +65,75 @@ password = os.environ.get("POSTGRES_PASSWORD", "postgres")
 database = os.environ.get("POSTGRES_DB", "iot_devices")
 
 DATABASE_URL = f"postgresql://{user}:{password}@{host}/{database}"
+POSTGRES_POOL_MIN_SIZE = int(os.environ.get("POSTGRES_POOL_MIN_SIZE", 2))
+POSTGRES_POOL_MAX_SIZE = int(os.environ.get("POSTGRES_POOL_MAX_SIZE", 10))
+
+DATAPOINTS_BY_TOPIC = "SELECT object_id, jsonpath, entity_id, entity_type, attribute_name, coalesce_updates FROM datapoints WHERE topic = $1"
+
+GATEWAY_ID = os.environ.get("GATEWAY_ID", socket.gethostname())
+GATEWAY_WORKERS = int(os.environ.get("GATEWAY_WORKERS", 12))
+GATEWAY_PROCESSES = int(os.environ.get("GATEWAY_PROCESSES", 1))
+# How several gateways share the topics, so that each message is handled by exactly one of them:
+# "none"   - a single gateway handles every topic
+# "shared" - MQTT v5 shared subscriptions, the broker hands each message to one gateway of the group
+# "hash"   - each topic is owned by one gateway, assigned by consistent hashing over the live gateways
+CLUSTER_MODE = os.environ.get(
+    "CLUSTER_MODE", "shared" if GATEWAY_PROCESSES > 1 else "none"
+)
+SHARED_SUBSCRIPTION_GROUP = os.environ.get("SHARED_SUBSCRIPTION_GROUP", "gateway")
+CLUSTER_HEARTBEAT_INTERVAL = float(os.environ.get("CLUSTER_HEARTBEAT_INTERVAL", 2))
+CLUSTER_MEMBER_TIMEOUT = float(os.environ.get("CLUSTER_MEMBER_TIMEOUT", 10))
+ORION_BATCH_WINDOW_MS = float(os.environ.get("ORION_BATCH_WINDOW_MS", 10))
+ORION_BATCH_MAX_ENTITIES = int(os.environ.get("ORION_BATCH_MAX_ENTITIES", 100))
+ORION_MAX_IN_FLIGHT = int(os.environ.get("ORION_MAX_IN_FLIGHT", 8))
+ORION_MAX_RETRIES = int(os.environ.get("ORION_MAX_RETRIES", 5))
+ORION_RETRY_BASE_DELAY = float(os.environ.get("ORION_RETRY_BASE_DELAY", 0.1))
+ORION_RETRY_MAX_DELAY = float(os.environ.get("ORION_RETRY_MAX_DELAY", 5))
+ORION_BREAKER_THRESHOLD = int(os.environ.get("ORION_BREAKER_THRESHOLD", 5))
+ORION_BREAKER_RESET_TIMEOUT = float(os.environ.get("ORION_BREAKER_RESET_TIMEOUT", 10))
+DEAD_LETTER_PATH = os.environ.get("DEAD_LETTER_PATH", "dead-letters.jsonl")
+# Directory of the on-disk spool for data received while Orion or the datapoint stores are down, empty to disable
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "")
+SPOOL_SEGMENT_SIZE = int(os.environ.get("SPOOL_SEGMENT_SIZE", 16 * 1024 * 1024))
+SPOOL_DRAIN_RATE = int(os.environ.get("SPOOL_DRAIN_RATE", 500))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json or text
+LOG_PATH = os.environ.get("LOG_PATH", "mqtt-gateway.log")
+# Per-message events (e.g. invalid payloads) are sampled and limited to LOG_MESSAGE_RATE per second and kind
+LOG_MESSAGE_SAMPLE_RATE = float(os.environ.get("LOG_MESSAGE_SAMPLE_RATE", 1))
+LOG_MESSAGE_RATE = float(os.environ.get("LOG_MESSAGE_RATE", 10))
+# Fraction of messages whose trace through the gateway is written to TRACE_PATH, 0 disables the trace file
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+TRACE_PATH = os.environ.get("TRACE_PATH", "traces.jsonl")
+# Port of the Prometheus metrics endpoint, 0 to disable. Process i of a multi-process gateway uses METRICS_PORT + i.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9101))
+QUEUE_MAXSIZE = int(os.environ.get("QUEUE_MAXSIZE", 10000))
+QUEUE_POLICY = os.environ.get("QUEUE_POLICY", "drop-oldest")
+# Minimum number of topics that only differ in one level which are covered by a single wildcard subscription,
+# 0 subscribes to every topic on its own. Not available in hash cluster mode, where topics are owned individually.
+SUBSCRIPTION_COMPACTION_MIN_GROUP = int(
+    os.environ.get("SUBSCRIPTION_COMPACTION_MIN_GROUP", 0)
+)
+# Maximum number of topics in a single SUBSCRIBE or UNSUBSCRIBE packet
+SUBSCRIBE_CHUNK_SIZE = int(os.environ.get("SUBSCRIBE_CHUNK_SIZE", 1000))
+# Maximum number of commands read from the manage_topics stream at once and how long a read blocks
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 500))
+STREAM_BLOCK_MS = int(os.environ.get("STREAM_BLOCK_MS", 1000))
+# Time in seconds after which the consumer group of a gateway that no longer reads the stream is removed, 0 keeps it
+STREAM_GROUP_EXPIRY = int(os.environ.get("STREAM_GROUP_EXPIRY", 86400))
+
+
+def subscription(topic: str) -> str:
+    """
+    Returns the topic filter the gateway subscribes to for the given topic.
+    With shared subscriptions, the broker delivers each message of the topic to only one gateway of the group.
+
+    Args:
+        topic (str): The MQTT topic.
+    """
+    if CLUSTER_MODE == "shared":
+        return f"$share/{SHARED_SUBSCRIPTION_GROUP}/{topic}"
+    return topic
 
 
 class MqttGateway(Client):
@@ -46,10 +147,23 @@ class MqttGateway(Client):
     The disadvantage of asynchronous programming is that it is more difficult to debug and it is not as efficient for CPU-bound tasks (which is not the case here).
     """
 
-    def __init__(self):
+    def __init__(self, index: int = 0):
+        """
+        Args:
+            index (int, optional): The index of the gateway process in multi-process mode. Defaults to 0.
+        """
         super().__init__(hostname=MQTT_HOST)
+        self.gateway_id = GATEWAY_ID if GATEWAY_PROCESSES == 1 else f"{GATEWAY_ID}-{index}"
         # Create gateway device
-        self.queue = asyncio.PriorityQueue()  # Queue for storing incoming messages
+        self.tracer = Tracer(
+            TRACE_PATH if GATEWAY_PROCESSES == 1 else f"{TRACE_PATH}.{index}",
+            sample_rate=TRACE_SAMPLE_RATE,
+        )  # Records the latency of the stages of the messages
+        self.queue = MessageQueue(
+            maxsize=QUEUE_MAXSIZE, policy=QUEUE_POLICY, tracer=self.tracer
+        )  # Bounded queue for storing incoming messages
+        if QUEUE_POLICY == BLOCK:
+            logging.getLogger("mqtt").addFilter(ClientBufferDrops(self.queue))
         self.workers = []  # List of worker tasks
         self.cache = aioredis.from_url(
             url=f"{REDIS_URL}/0"
@@ -57,9 +171,59 @@ class MqttGateway(Client):
         self.notifier = aioredis.from_url(
             url=f"{REDIS_URL}/1"
         )  # Redis Stream for notifying the API about new datapoints
-        self.conn = None  # Initialized in run()
-        self.logger = Logger.with_default_handlers(name="mqtt-gateway")
-        self.logger.add_handler(AsyncFileHandler("mqtt-gateway.log"))
+        self.routes = RoutingTable()  # In-memory topic -> datapoint routing table
+        self.loading = {}  # Topics whose datapoints are currently loaded, shared by all workers
+        self.pool = None  # Pool of Postgres connections, initialized in run()
+        self.topics = set()  # All topics with registered datapoints
+        self.config_version = None  # Last version of the configuration from the manage_topics stream, None if unknown
+        self.patterns = TopicTrie()  # Wildcard topics of datapoints
+        self.subscriptions = SubscriptionPlan(
+            SUBSCRIPTION_COMPACTION_MIN_GROUP if CLUSTER_MODE != "hash" else 0
+        )  # Topic filters this gateway is subscribed to and the topics they cover
+        self.subscription_lock = asyncio.Lock()
+        self.membership = ClusterMembership(
+            self.notifier, self.gateway_id, timeout=CLUSTER_MEMBER_TIMEOUT
+        )  # Live gateways in hash cluster mode
+        self.ring = None  # Consistent hash ring of the live gateways, set in rebalance()
+        self.releasing = set()  # Topics that moved to another gateway
+        self.logger = logging.getLogger("mqtt-gateway")  # Configured by setup_logging()
+        self.message_logger = self.logger.getChild("messages")  # Sampled and rate limited
+        self.spool = (
+            Spool(
+                SPOOL_DIR if GATEWAY_PROCESSES == 1 else os.path.join(SPOOL_DIR, str(index)),
+                segment_size=SPOOL_SEGMENT_SIZE,
+            )
+            if SPOOL_DIR
+            else None
+        )  # Buffers data on disk while the downstream services are unavailable
+        self.batcher = OrionBatcher(
+            url=orion,
+            headers={
+                "fiware-service": header.service,
+                "fiware-servicepath": header.service_path,
+            },
+            logger=self.logger,
+            window=ORION_BATCH_WINDOW_MS / 1000,
+            max_entities=ORION_BATCH_MAX_ENTITIES,
+            max_in_flight=ORION_MAX_IN_FLIGHT,
+            max_retries=ORION_MAX_RETRIES,
+            retry_base_delay=ORION_RETRY_BASE_DELAY,
+            retry_max_delay=ORION_RETRY_MAX_DELAY,
+            breaker=CircuitBreaker(
+                failure_threshold=ORION_BREAKER_THRESHOLD,
+                reset_timeout=ORION_BREAKER_RESET_TIMEOUT,
+            ),
+            dead_letters=DeadLetterStore(
+                DEAD_LETTER_PATH
+                if GATEWAY_PROCESSES == 1
+                else f"{DEAD_LETTER_PATH}.{index}"
+            ),
+            spool=self.spool,
+            tracer=self.tracer,
+        )  # Collects attribute updates and sends them to Orion in batches
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+        SUBSCRIPTIONS.set_function(lambda: len(self.subscriptions))
+        ORION_BREAKER_OPEN.set_function(lambda: not self.batcher.breaker.closed)
 
     async def worker(self, client: Client) -> None:
         """
@@ -68,24 +232,27 @@ class MqttGateway(Client):
         Args:
             client (Client): The MQTT client used by the gateway. The Client object is from the asyncio_mqtt library.
         """
-        async with aiohttp.ClientSession() as worker_session:
-            async with Client(MQTT_HOST) as worker_client:
-                while True:
-                    # Wait for a message from the queue
-                    try:
-                        _, source, *message = await self.queue.get()
-                        if source == "redis":
-                            await self.process_redis_message(*message, client=client)
-                        elif source == "mqtt":
-                            await self.process_mqtt_message(
-                                *message, worker_client, worker_session
-                            )
-                        else:
-                            self.logger.error(f"Unknown source: {source}")
-                        self.queue.task_done()
-                    except Exception as e:
-                        self.logger.error(e)
-                        continue
+        while True:
+            # Wait for a message from the queue
+            try:
+                _, source, *message = await self.queue.get()
+                WORKERS_BUSY.inc()
+                start = time.perf_counter()
+                try:
+                    if source == "redis":
+                        await self.process_redis_message(*message, client=client)
+                    elif source == "mqtt":
+                        await self.process_mqtt_message(*message)
+                    else:
+                        self.logger.error("Unknown source: %s", source)
+                finally:
+                    WORKERS_BUSY.dec()
+                    WORKER_BUSY_SECONDS.inc(time.perf_counter() - start)
+                self.queue.task_done()
+            except Exception as e:
+                ERRORS.labels("worker").inc()
+                self.logger.error("Processing a message failed: %s", e)
+                continue
 
     async def start_workers(self, client: Client) -> None:
         """
@@ -94,98 +261,331 @@ class MqttGateway(Client):
         Args:
             client (Client): The MQTT client used by the gateway. The Client object is from the asyncio_mqtt library.
         """
-        workers = [asyncio.create_task(self.worker(client)) for _ in range(12)]
+        workers = [
+            asyncio.create_task(self.worker(client)) for _ in range(GATEWAY_WORKERS)
+        ]
+        WORKERS.set(GATEWAY_WORKERS)
         await asyncio.gather(*workers)
 
     async def process_redis_message(
-        self, message: bytes, client: Client
+        self, message: Tuple[List[Dict[bytes, bytes]], asyncio.Future], client: Client
     ) -> None:
         """
-        Processes a single Redis message.
+        Processes a batch of commands from the manage_topics stream.
 
         Args:
-            message (Tuple[str, str, Client]): A tuple containing the command, the topic, and the MQTT client used by the gateway.
+            message (Tuple[List[Dict[bytes, bytes]], asyncio.Future]): The fields of the stream entries and a future
+                that is resolved once the commands have been processed, or fails with the error that stopped them.
+            client (Client): The MQTT client used by the gateway.
         """
-        decoded_data = {k.decode(): v.decode() for k, v in message.items()}
+        commands, done = message
+        try:
+            await self.process_commands(commands, client)
+        except Exception as e:
+            done.set_exception(e)
+        else:
+            done.set_result(None)
 
-        command = list(decoded_data.keys())[0]
-        topic = list(decoded_data.values())[0]
+    async def process_commands(
+        self, commands: List[Dict[bytes, bytes]], client: Client
+    ) -> None:
+        """
+        Processes commands from the manage_topics stream. The subscription changes of all commands are
+        coalesced and sent to the broker in as few SUBSCRIBE and UNSUBSCRIBE packets as possible.
 
-        try:
-            print(f"Processing command: {command} {topic}")
+        Args:
+            commands (List[Dict[bytes, bytes]]): The fields of the stream entries, each an operation on one or more topics.
+            client (Client): The MQTT client used by the gateway.
+        """
+        subscribe, unsubscribe = set(), set()
+        operations = []
+        missed = False
+        # The config version only moves forward once the batch has been applied, so a batch whose resync failed
+        # reveals the gap again when it is replayed
+        version = self.config_version
+        for data in commands:
+            try:
+                config_version, entry_operations = parse_entry(data)
+            except ValueError as e:
+                # A malformed entry is skipped, replaying it would not help. Its config version is not applied,
+                # so the next entry reveals the gap and the configuration is reloaded.
+                ERRORS.labels("stream").inc()
+                self.logger.error("Invalid stream entry %s: %s", data, e)
+                continue
+            if config_version is not None:
+                if version is not None and config_version > version + 1:
+                    self.logger.warning("Missed config versions %d to %d", version + 1, config_version - 1)
+                    missed = True
+                # Replayed entries are older than the current version, which must not go back
+                if version is None or config_version > version:
+                    version = config_version
+            operations.extend(entry_operations)
+
+        if missed:
+            # The operations of the batch are applied on top of the reloaded topics. Each topic ends up in the state of
+            # its last operation, so applying operations that are already reflected in the reload does no harm.
+            await self.resync(client)
+
+        for command, topic in operations:
+            self.logger.debug("Processing command: %s %s", command, topic)
             if command == "subscribe":
-                await client.subscribe(topic)
-                self.logger.info(f"Subscribed to {topic}")
+                self.routes.invalidate(topic)
+                self.topics.add(topic)
+                if is_wildcard(topic):
+                    self.patterns.insert(topic, topic)
+                unsubscribe.discard(topic)
+                if self.owns(topic):
+                    subscribe.add(topic)
             elif command == "unsubscribe":
-                await client.unsubscribe(topic)
-                self.logger.info(f"Unsubscribed from {topic}")
+                self.routes.invalidate(topic)
+                self.topics.discard(topic)
+                self.patterns.remove(topic)
+                subscribe.discard(topic)
+                unsubscribe.add(topic)
+            elif command == "invalidate":
+                self.routes.invalidate(topic)
+                self.logger.debug("Invalidated routes of %s", topic)
             else:
-                self.logger.error(f"Unknown command: {command}")
-        except Exception as e:
-            self.logger.error(e)
-        finally:
-            self.logger.info(f"Done processing command: {command} {topic}")
+                self.logger.error("Unknown command: %s", command)
 
-    async def process_mqtt_message(
-        self, message: Tuple[str, str], client: Client, session: aiohttp.ClientSession
-    ) -> None:
+        if version != self.config_version:
+            self.config_version = version
+            CONFIG_VERSION.set(version)
+        if not (subscribe or unsubscribe):
+            return
+        try:
+            async with self.subscription_lock:
+                await self.unsubscribe_topics(client, unsubscribe)
+                await self.subscribe_topics(client, subscribe)
+        except MqttError as e:
+            self.logger.error(
+                "Updating subscriptions (%d new, %d removed) failed: %s",
+                len(subscribe),
+                len(unsubscribe),
+                e,
+            )
+        else:
+            self.logger.info(
+                "Updated subscriptions (%d new, %d removed)", len(subscribe), len(unsubscribe)
+            )
+
+    async def process_mqtt_message(self, message: Tuple[str, bytes, Trace]) -> None:
         """
         Processes a single MQTT message.
 
         Args:
-            message (Tuple[str, str, Client]): A tuple containing the topic, the payload, and the MQTT client used by the gateway.
+            message (Tuple[str, bytes, Trace]): A tuple containing the topic, the payload and the trace of the message.
+        """
+        topic, payload, trace = message
+        trace.mark("dequeued")
+        try:
+            await self.route_mqtt_message(topic, payload, trace)
+        finally:
+            self.tracer.release(trace)
+
+    async def route_mqtt_message(self, topic: str, payload: bytes, trace: Trace) -> None:
         """
-        topic, payload = message
+        Extracts the values of the datapoints of the topic from the payload and hands them over to the batcher.
 
-        # Get all datapoints for the topic from the cache
-        # If the topic is not in the cache, ask Postgres
-        if not await self.cache.hlen(topic):
-            await self.logger.info(
-                f"No datapoints found for topic {topic} in cache, asking Postgres..."
-            )
-            datapoints = await self.get_datapoints_by_topic(topic)
-            if not datapoints:
-                await self.logger.info(
-                    f"No datapoints found for topic {topic} in Postgres"
-                )
-                return
-            await self.logger.info(f"Got {len(datapoints)} datapoints from Postgres")
-            # Add the datapoints to the cache
-            for datapoint in datapoints:
-                await self.cache.hset(
-                    topic, datapoint["object_id"], json.dumps(datapoint)
-                )
+        Args:
+            topic (str): The topic of the message.
+            payload (bytes): The payload of the message.
+            trace (Trace): The trace of the message.
+        """
 
-        datapoints = await self.cache.hgetall(topic)
-        for datapoint in datapoints.values():
-            datapoint = json.loads(datapoint.decode("utf-8"))
-            # Get the value from the payload using jsonpath
-            value = (
-                parse(datapoint["jsonpath"])
-                .find(json.loads(payload.decode("utf-8")))[0]
-                .value
+        try:
+            routes = await self.get_routes(topic)
+        except Exception as e:
+            if self.spool is None:
+                raise
+            # Neither the cache nor Postgres is available, keep the message until they are back
+            ERRORS.labels("routing").inc()
+            self.message_logger.warning("Spooling message on topic %s: %s", topic, e)
+            self.spool.append(
+                {
+                    "kind": "message",
+                    "topic": topic,
+                    "payload": base64.b64encode(payload).decode(),
+                }
             )
+            SPOOLED.labels("message").inc()
+            return
+        trace.mark("routed")
+        if not routes:
+            return
+
+        # Decode the payload once and share it across all datapoints of the topic
+        try:
+            data = json.loads(payload)
+        except ValueError as e:
+            self.message_logger.error("Invalid JSON payload on topic %s: %s", topic, e)
+            return
+
+        values = []
+        for route in routes:
+            if not route.matched:
+                continue
+            # Get the value from the payload using the compiled jsonpath
+            matches = route.expression.find(data)
+            if not matches:
+                continue
+            value = matches[0].value
             if value:
-                payload = {
-                    datapoint["attribute_name"]: {
-                        "type": "Number",
-                        "value": value,
-                    }
-                }
-                # Send the payload to the Orion Context Broker
-                try:
-                    await session.patch(
-                        url=f"{orion}/v2/entities/{datapoint['entity_id']}/attrs?type={datapoint['entity_type']}",
-                        json=payload,
-                        headers={
-                            "fiware-service": header.service,
-                            "fiware-servicepath": header.service_path,
-                        },
-                    )
-                    await self.logger.info(f"Sent {payload} to Orion Context Broker")
-                except Exception as e:
-                    await self.logger.error(e)
+                values.append((route, value))
+        trace.mark("extracted")
+
+        for route, value in values:
+            MESSAGES_FORWARDED.labels(topic_label(topic)).inc()
+            # Hand the value over to the batcher which sends it to the Orion Context Broker
+            await self.batcher.submit(
+                route.entity_id,
+                route.entity_type,
+                route.attribute_name,
+                value,
+                coalesce=route.coalesce,
+                trace=trace,
+            )
+
+    async def get_routes(self, topic: str) -> Tuple[Route, ...]:
+        """
+        Returns the routes of all datapoints for the topic from the in-memory routing table.
+        If the topic has not been loaded yet, its datapoints are read from the cache, and if they are not
+        in the cache either, from Postgres. The table is kept in sync via the manage_topics stream.
+
+        Args:
+            topic (str): The MQTT topic of the message.
+        """
+        routes = self.routes.get(topic)
+        if routes is not None:
+            ROUTE_CACHE.labels("hit").inc()
+            return routes
+        ROUTE_CACHE.labels("miss").inc()
+
+        # Workers that miss the same topic at the same time share a single load
+        loading = self.loading.get(topic)
+        if loading is None:
+            loading = self.loading[topic] = asyncio.ensure_future(self.load_routes(topic))
+            loading.add_done_callback(lambda _: self.loading.pop(topic, None))
+        return await asyncio.shield(loading)
+
+    async def load_routes(self, topic: str) -> Tuple[Route, ...]:
+        """
+        Loads the datapoints for the topic and stores their routes in the routing table.
+        These are the datapoints of the topic itself and of all wildcard topics that match it, found via
+        the trie of wildcard topics. Only the topics this gateway is subscribed for are included, so in hash
+        cluster mode a message is not handled by both the owner of its topic and the owner of a wildcard topic.
+
+        Args:
+            topic (str): The MQTT topic.
+        """
+        epoch = self.routes.epoch
+        datapoints = []
+        for registered in [topic, *self.patterns.match(topic)]:
+            if registered in self.subscriptions:
+                datapoints.extend(await self.load_datapoints(registered))
+        return self.routes.set(topic, datapoints, epoch)
+
+    async def load_datapoints(self, topic: str) -> List[Dict[str, Any]]:
+        """
+        Loads all datapoints for the topic from the cache. If the topic is not in the cache, ask Postgres
+        and add the datapoints to the cache.
+
+        Args:
+            topic (str): The MQTT topic.
+        """
+        try:
+            cached = await self.cache.hgetall(topic)
+        except RedisError as e:
+            REDIS_CACHE.labels("error").inc()
+            POSTGRES_FALLBACKS.inc()
+            self.message_logger.warning(
+                "Cache unavailable, asking Postgres for topic %s: %s", topic, e
+            )
+            return await self.get_datapoints_by_topic(topic)
+        if cached:
+            REDIS_CACHE.labels("hit").inc()
+            return [json.loads(datapoint) for datapoint in cached.values()]
+        REDIS_CACHE.labels("miss").inc()
+        POSTGRES_FALLBACKS.inc()
+
+        self.logger.debug("No datapoints found for topic %s in cache, asking Postgres...", topic)
+        datapoints = await self.get_datapoints_by_topic(topic)
+        if not datapoints:
+            self.logger.debug("No datapoints found for topic %s in Postgres", topic)
+            return []
+        self.logger.debug("Got %d datapoints from Postgres", len(datapoints))
+        # Add the datapoints to the cache
+        await self.cache.hset(
+            topic,
+            mapping={
+                datapoint["object_id"]: json.dumps(datapoint) for datapoint in datapoints
+            },
+        )
+        return datapoints
+
+    async def spool_drainer(self) -> None:
+        """
+        Drains the spool in order at a controlled rate of SPOOL_DRAIN_RATE records per second, as long as the
+        service each record waits for is available again. Spooled updates wait for Orion and go through the
+        batcher like new batches, leaving out attributes that have been sent again since. Spooled messages wait
+        for the cache or Postgres and are put back into the queue, where they wait for room instead of being dropped.
+        Records that fail again are spooled again.
+        """
+        while True:
+            await asyncio.sleep(1)
+            try:
+                await asyncio.to_thread(self.spool.flush)
+                if not self.spool.pending():
                     continue
+                records = await asyncio.to_thread(self.spool.read, SPOOL_DRAIN_RATE)
+                available = {
+                    "update": self.batcher.breaker.ready(),
+                    "message": any(record["kind"] == "message" for record, _ in records)
+                    and await self.routing_available(),
+                }
+                position = None
+                drained = 0
+                updates = []
+                for record, end in records:
+                    if not available[record["kind"]]:
+                        break  # The remaining records wait for the next round to keep their order
+                    if record["kind"] == "update":
+                        done = await self.batcher.resend(record["entities"], record["time"])
+                        if done is not None:
+                            updates.append(done)
+                    else:
+                        await self.queue.put_mqtt(
+                            record["topic"],
+                            base64.b64decode(record["payload"]),
+                            trace=self.tracer.start(record["topic"]),
+                            policy=BLOCK,
+                        )
+                    position = end
+                    drained += 1
+                if updates:
+                    await asyncio.wait(updates)
+                if position is not None:
+                    await asyncio.to_thread(self.spool.commit, position)
+                    self.logger.info("Drained %d records from the spool", drained)
+            except Exception as e:
+                ERRORS.labels("spool").inc()
+                self.logger.error("Draining the spool failed: %s", e)
+
+    async def routing_available(self) -> bool:
+        """
+        Returns whether the datapoints of a topic can be loaded, from the cache or else from Postgres.
+        """
+        try:
+            await self.cache.ping()
+            return True
+        except RedisError:
+            pass
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.fetchval("SELECT 1")
+            return True
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError):
+            return False
 
     async def mqtt_listener(self, client: Client) -> None:
         """
@@ -197,82 +597,331 @@ class MqttGateway(Client):
         Args:
             client (Client): The MQTT client used by the gateway. The Client object is from the asyncio_mqtt library.
         """
-        print("Listening to MQTT...")
-        topics = await self.get_unique_topics()
-        print(f"Subscribing to {len(topics)} topics... ({topics})")
-        for topic in topics:
-            await client.subscribe(topic)
-            print(f"Subscribed to topic {topic}")
-        async with client.messages() as messages:
+        self.logger.info("Listening to MQTT...")
+        # The version is read before the topics, so a change made in between shows up as a gap
+        self.config_version = await self.get_config_version()
+        if self.config_version is not None:
+            CONFIG_VERSION.set(self.config_version)
+        self.topics = set(await self.get_unique_topics())
+        self.patterns = TopicTrie()
+        for topic in self.topics:
+            if is_wildcard(topic):
+                self.patterns.insert(topic, topic)
+        self.subscriptions.clear()  # A new connection starts without subscriptions
+        if CLUSTER_MODE == "hash":
+            await self.rebalance(client, await self.membership.heartbeat())
+        else:
+            self.logger.info("Subscribing to %d topics...", len(self.topics))
+            async with self.subscription_lock:
+                await self.subscribe_topics(client, self.topics)
+            self.logger.info(
+                "Subscribed to %d topics with %d topic filters",
+                len(self.topics),
+                len(self.subscriptions),
+            )
+        # With the block policy, the client buffers at most as many messages as the queue while the reader waits
+        # and drops the newest beyond that, so memory stays bounded either way
+        queue_maxsize = QUEUE_MAXSIZE if QUEUE_POLICY == BLOCK else 0
+        compacted = self.subscriptions.min_group > 0
+        async with client.messages(queue_maxsize=queue_maxsize) as messages:
             async for message in messages:
-                self.queue.put_nowait(
-                    (1, "mqtt", (str(message.topic), message.payload))
+                topic = str(message.topic)
+                if compacted and topic not in self.subscriptions and not self.patterns.match(topic):
+                    continue  # Delivered by a wildcard subscription, but has no datapoints
+                MESSAGES_RECEIVED.labels(topic_label(topic)).inc()
+                await self.queue.put_mqtt(
+                    topic,
+                    message.payload,
+                    coalesce=is_coalesced(topic),
+                    trace=self.tracer.start(topic),
                 )
 
+    async def resync(self, client: Client) -> None:
+        """
+        Reloads all topics from Postgres after changes on the manage_topics stream were missed and drops all cached routes.
+        The subscriptions are brought in line with the reloaded topics.
+
+        Args:
+            client (Client): The MQTT client used by the gateway.
+        """
+        CONFIG_RESYNCS.inc()
+        self.topics = set(await self.get_unique_topics())
+        self.patterns = TopicTrie()
+        for topic in self.topics:
+            if is_wildcard(topic):
+                self.patterns.insert(topic, topic)
+        self.routes.clear()
+        try:
+            async with self.subscription_lock:
+                subscribed = self.subscriptions.topics
+                owned = {topic for topic in self.topics if self.owns(topic)}
+                await self.unsubscribe_topics(client, subscribed - self.topics)
+                await self.subscribe_topics(client, owned - subscribed)
+        except MqttError as e:
+            self.logger.error("Updating subscriptions after reloading the topics failed: %s", e)
+        self.logger.info("Reloaded %d topics", len(self.topics))
+
+    def owns(self, topic: str) -> bool:
+        """
+        Returns whether this gateway is responsible for the topic.
+        In hash cluster mode, every topic is owned by exactly one of the live gateways.
+
+        Args:
+            topic (str): The MQTT topic.
+        """
+        if CLUSTER_MODE != "hash":
+            return True
+        return self.ring is not None and self.ring.owner(topic) == self.gateway_id
+
+    async def subscribe_topics(self, client: Client, topics: Iterable[str]) -> None:
+        """
+        Subscribes to the given topics unless already subscribed. The caller holds the subscription lock.
+        Topics that are covered by a wildcard subscription are not subscribed to again. The topic filters
+        are sent in SUBSCRIBE packets of up to SUBSCRIBE_CHUNK_SIZE filters each.
+
+        Args:
+            client (Client): The MQTT client used by the gateway.
+            topics (Iterable[str]): The MQTT topics.
+        """
+        await self.update_subscriptions(client, *self.subscriptions.add(topics))
+
+    async def unsubscribe_topics(self, client: Client, topics: Iterable[str]) -> None:
+        """
+        Unsubscribes from the given topics if subscribed. The caller holds the subscription lock.
+        A wildcard subscription is only removed once none of its topics are left. The topics that were covered
+        by a removed wildcard topic of a datapoint are subscribed to on their own before it is removed.
+
+        Args:
+            client (Client): The MQTT client used by the gateway.
+            topics (Iterable[str]): The MQTT topics.
+        """
+        await self.update_subscriptions(client, *self.subscriptions.remove(topics))
+
+    async def update_subscriptions(
+        self, client: Client, topic_filters: List[str], unused: List[str]
+    ) -> None:
+        """
+        Subscribes to the new topic filters of the subscription plan, then unsubscribes from the filters it no longer
+        uses. The topic filters are sent in packets of up to SUBSCRIBE_CHUNK_SIZE filters each.
+
+        Args:
+            client (Client): The MQTT client used by the gateway.
+            topic_filters (List[str]): The topic filters to subscribe to.
+            unused (List[str]): The topic filters to unsubscribe from.
+        """
+        for i in range(0, len(topic_filters), SUBSCRIBE_CHUNK_SIZE):
+            chunk = topic_filters[i : i + SUBSCRIBE_CHUNK_SIZE]
+            try:
+                reason_codes = await client.subscribe(
+                    [(subscription(topic_filter), 0) for topic_filter in chunk]
+                )
+            except MqttError:
+                for topic_filter in topic_filters[i:]:
+                    self.subscriptions.drop(topic_filter)
+                raise
+            for topic_filter, reason_code in zip(chunk, reason_codes):
+                # MQTT 5 returns reason codes, MQTT 3 the granted QoS, anything from 0x80 on is a failure
+                if getattr(reason_code, "value", reason_code) >= 0x80:
+                    self.logger.error("Subscribing to %s failed: %s", topic_filter, reason_code)
+                    self.subscriptions.drop(topic_filter)
+            self.logger.debug("Subscribed to %d topic filters", len(chunk))
+        # Filters that are replaced by the new subscriptions are only released once these are in place
+        for i in range(0, len(unused), SUBSCRIBE_CHUNK_SIZE):
+            chunk = unused[i : i + SUBSCRIBE_CHUNK_SIZE]
+            await client.unsubscribe([subscription(topic_filter) for topic_filter in chunk])
+            self.logger.debug("Unsubscribed from %d topic filters", len(chunk))
+
+    async def rebalance(self, client: Client, members: List[str]) -> None:
+        """
+        Recomputes which topics this gateway owns after the set of live gateways has changed.
+        Newly owned topics are subscribed to right away, while topics that moved to another gateway are
+        only released on the next heartbeat. Until the new owner has subscribed, they are handled twice
+        rather than not at all.
+
+        Args:
+            client (Client): The MQTT client used by the gateway.
+            members (List[str]): The ids of the live gateways.
+        """
+        async with self.subscription_lock:
+            self.ring = HashRing(members)
+            owned = {topic for topic in self.topics if self.owns(topic)}
+            self.logger.info(
+                "Cluster of %d gateways, owning %d of %d topics",
+                len(members),
+                len(owned),
+                len(self.topics),
+            )
+            subscribed = self.subscriptions.topics
+            await self.subscribe_topics(client, owned - subscribed)
+            self.releasing = subscribed - owned
+            # The routes of a topic depend on which of its wildcard topics this gateway owns
+            self.routes.clear()
+
+    async def cluster_listener(self, client: Client) -> None:
+        """
+        Sends heartbeats to the other gateways in hash cluster mode and rebalances the topics whenever a gateway
+        joins or dies.
+
+        Args:
+            client (Client): The MQTT client used by the gateway.
+        """
+        while True:
+            await asyncio.sleep(CLUSTER_HEARTBEAT_INTERVAL)
+            try:
+                members = await self.membership.heartbeat()
+                if self.ring is None or sorted(members) != self.ring.members:
+                    await self.rebalance(client, members)
+                elif self.releasing:
+                    async with self.subscription_lock:
+                        released = {t for t in self.releasing if not self.owns(t)}
+                        await self.unsubscribe_topics(client, released)
+                        # Messages of the released topics are no longer routed to their datapoints here
+                        for topic in released:
+                            self.routes.invalidate(topic)
+                        self.releasing = set()
+            except MqttError:
+                raise
+            except Exception as e:
+                ERRORS.labels("cluster").inc()
+                self.logger.error("Cluster heartbeat failed: %s", e)
+
     async def redis_listener(self, client: Client) -> None:
         """
-        Listens to Redis for new messages on subscribed channels. When a message is received, the on_redis_message callback function is called.
-        Also subscribes to all channels in the database on startup.
-        The callback function is called asynchronously, which means that the listener can continue to listen for new messages while the callback function is being executed.
+        Listens to the manage_topics stream for commands of the API and hands them over to the workers.
+        Commands are read in batches of up to STREAM_BATCH_SIZE with a blocking read and acknowledged together
+        once the whole batch has been processed. Commands that were read but not acknowledged, because the gateway
+        stopped or processing them failed, are still pending in the consumer group and are replayed.
 
         Args:
             client (Client): The MQTT client used by the gateway. The Client object is from the asyncio_mqtt library.
         """
         stream_name = "manage_topics"
-        group_name = "manage_topics_group"
-        consumer_name = str(uuid4())
+        # Every gateway needs to see every command to keep its routing table in sync,
+        # so each gateway reads the stream in its own consumer group.
+        group_name = f"manage_topics_group:{self.gateway_id}"
+        consumer_name = self.gateway_id
 
         try:
             await self.notifier.xgroup_create(stream_name, group_name, mkstream=True)
-        except Exception as e:
-            print(e)
-            pass
+        except RedisError as e:
+            self.logger.debug("Consumer group %s not created: %s", group_name, e)
+        if STREAM_GROUP_EXPIRY:
+            await self.remove_stale_groups(stream_name, group_name)
 
-        print(f"Listening to Stream {stream_name}...")
+        self.logger.info("Listening to Stream %s...", stream_name)
+        # Start with the pending entries of this consumer, then switch to new entries
+        last_id = "0"
         while True:
             try:
-                async with async_timeout.timeout(1):
-                    messages = await self.notifier.xreadgroup(
-                        group_name,
-                        consumer_name,
-                        {stream_name: ">"},
-                        count=1,
-                    )
-                    for message in messages:
-                        stream, payload = message
-                        message_id, data = payload[0]
-                        print(f"Received message {message_id}")
-                        print(f"Received data {data}")
-                        self.queue.put_nowait((0, "redis", data))
-                        await self.notifier.xack(stream_name, group_name, message_id.decode("utf-8"))
-            except asyncio.TimeoutError:
-                pass
-                    
-                        # The following methods are used to interact with the Postgres database.
+                response = await self.notifier.xreadgroup(
+                    group_name,
+                    consumer_name,
+                    {stream_name: last_id},
+                    count=STREAM_BATCH_SIZE,
+                    block=None if last_id != ">" else STREAM_BLOCK_MS,
+                )
+            except RedisError as e:
+                ERRORS.labels("stream").inc()
+                self.logger.error("Reading stream %s failed: %s", stream_name, e)
+                await asyncio.sleep(1)
+                continue
+            entries = response[0][1] if response else []
+            if last_id != ">":
+                if not entries:
+                    last_id = ">"
+                    continue
+                self.logger.info("Replaying %d unacknowledged commands", len(entries))
+                last_id = entries[-1][0]
+            if not entries:
+                continue
+
+            # Pending entries that have been trimmed from the stream come back empty
+            commands = [data for _, data in entries if data]
+            if commands:
+                # The batch is processed as a whole, so its subscription changes can be coalesced
+                done = asyncio.get_running_loop().create_future()
+                self.queue.put_control((commands, done))
+                try:
+                    await done
+                except Exception as e:
+                    # The batch is not acknowledged and stays pending, so it is read again from the start
+                    ERRORS.labels("stream").inc()
+                    self.logger.error("Processing %d commands failed, retrying: %s", len(entries), e)
+                    last_id = "0"
+                    await asyncio.sleep(1)
+                    continue
+            self.logger.debug("Processed %d commands", len(entries))
+            try:
+                await self.notifier.xack(
+                    stream_name, group_name, *(message_id for message_id, _ in entries)
+                )
+            except RedisError as e:
+                # The commands stay pending and are replayed on the next start, which does no harm
+                ERRORS.labels("stream").inc()
+                self.logger.error("Acknowledging %d commands failed: %s", len(entries), e)
+
+    async def remove_stale_groups(self, stream_name: str, group_name: str) -> None:
+        """
+        Removes the consumer groups of gateways that have not read the stream for STREAM_GROUP_EXPIRY seconds,
+        e.g. of containers that were recreated under a new hostname. Their pending entries would otherwise
+        be kept forever.
+
+        Args:
+            stream_name (str): The name of the stream.
+            group_name (str): The consumer group of this gateway, which is kept.
+        """
+        try:
+            for group in await self.notifier.xinfo_groups(stream_name):
+                name = group["name"].decode()
+                if not name.startswith("manage_topics_group:") or name == group_name:
+                    continue
+                consumers = await self.notifier.xinfo_consumers(stream_name, name)
+                # A group without consumers may belong to a gateway that is just starting
+                if consumers and all(
+                    consumer["idle"] >= STREAM_GROUP_EXPIRY * 1000 for consumer in consumers
+                ):
+                    await self.notifier.xgroup_destroy(stream_name, name)
+                    self.logger.info("Removed stale consumer group %s", name)
+        except RedisError as e:
+            ERRORS.labels("stream").inc()
+            self.logger.error("Removing stale consumer groups failed: %s", e)
+
+    async def get_config_version(self) -> Optional[int]:
+        """
+        Returns the current version of the configuration, i.e. of the last entry the API added to the manage_topics stream,
+        or None if it is unknown.
+        """
+        try:
+            version = await self.notifier.get("config_version")
+        except RedisError as e:
+            ERRORS.labels("stream").inc()
+            self.logger.error("Reading the config version failed: %s", e)
+            return None
+        return int(version or 0)
+
+    # The following methods are used to interact with the Postgres database.
     async def get_datapoints(self):
         """
         Returns a list of all datapoints in the Postgres database.
         """
-        async with self.conn.transaction():
-            return await self.conn.fetch("SELECT * FROM datapoints")
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("SELECT * FROM datapoints")
 
     async def get_datapoints_by_topic(self, topic: str):
         """
         Returns a list of all datapoints with the given topic in the Postgres database.
+        The query is prepared once per pooled connection and reused from asyncpg's statement cache.
         """
-        async with self.conn.transaction():
-            records = await self.conn.fetch(
-                "SELECT object_id, jsonpath, entity_id, entity_type, attribute_name FROM datapoints WHERE topic = $1",
-                topic,
-            )
+        async with self.pool.acquire() as conn:
+            records = await conn.fetch(DATAPOINTS_BY_TOPIC, topic)
             return [dict(record) for record in records]
 
     async def get_unique_topics(self) -> List[str]:
         """
         Returns a list of all unique topics in the Postgres database.
         """
-        async with self.conn.transaction():
-            records = await self.conn.fetch("SELECT DISTINCT topic FROM datapoints")
+        async with self.pool.acquire() as conn:
+            records = await conn.fetch("SELECT DISTINCT topic FROM datapoints")
             return [record["topic"] for record in records]
 
     # End of Postgres methods
@@ -281,28 +930,124 @@ class MqttGateway(Client):
         """
         Starts the gateway and runs the main loop. Simultaneously listens to PostgreSQL for new topics to subscribe or unsubscribe to.
         In case of a connection error, the gateway will try to reconnect after 5 seconds and will continue to do so until a connection is established.
+        Runs until cancelled, e.g. by SIGTERM. In hash cluster mode, the gateway then leaves the cluster.
         """
         await self.cache.flushdb()
-        self.conn = await asyncpg.connect(DATABASE_URL)
-        self.s = aiohttp.ClientSession()
+        self.pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=POSTGRES_POOL_MIN_SIZE,
+            max_size=POSTGRES_POOL_MAX_SIZE,
+        )
+        self.batcher_task = asyncio.create_task(self.batcher.run())
+        if self.spool is not None:
+            self.spool_task = asyncio.create_task(self.spool_drainer())
+        if self.tracer.sample_rate:
+            self.tracer_task = asyncio.create_task(self.tracer.run())
+        # Stopping the container cancels the gateway, so it can leave the cluster
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            while True:
+                reconnect_interval = 5
+                try:
+                    async with Client(
+                        hostname=MQTT_HOST, protocol=ProtocolVersion.V5
+                    ) as client:
+                        tasks = [
+                            asyncio.create_task(self.mqtt_listener(client)),
+                            asyncio.create_task(self.redis_listener(client)),
+                            asyncio.create_task(self.start_workers(client)),
+                        ]
+                        if CLUSTER_MODE == "hash":
+                            tasks.append(asyncio.create_task(self.cluster_listener(client)))
+                        try:
+                            await asyncio.gather(*tasks)
+                        finally:
+                            # gather leaves the other tasks running, they must not outlive the connection
+                            for task in tasks:
+                                task.cancel()
+                            await asyncio.gather(*tasks, return_exceptions=True)
+                except MqttError as error:
+                    self.logger.error(
+                        "MQTT error: %s - reconnecting in %d seconds", error, reconnect_interval
+                    )
+                    await asyncio.sleep(reconnect_interval)
+        finally:
+            if CLUSTER_MODE == "hash":
+                # The other gateways take over the topics right away instead of waiting for the timeout
+                try:
+                    await self.membership.leave()
+                except RedisError as e:
+                    self.logger.error("Leaving the cluster failed: %s", e)
+
+
+def run_gateway(index: int = 0) -> None:
+    """
+    Runs a single gateway process.
+
+    Args:
+        index (int, optional): The index of the gateway process. Defaults to 0.
+    """
+    setup_logging(
+        "mqtt-gateway",
+        LOG_PATH if GATEWAY_PROCESSES == 1 else f"{LOG_PATH}.{index}",
+        level=LOG_LEVEL,
+        log_format=LOG_FORMAT,
+        message_sample_rate=LOG_MESSAGE_SAMPLE_RATE,
+        message_rate=LOG_MESSAGE_RATE,
+    )
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT + index)
+    gateway = MqttGateway(index)
+    try:
+        asyncio.run(gateway.run())
+    except asyncio.CancelledError:
+        pass  # Stopped by SIGTERM
+
+
+def supervise(processes: int) -> None:
+    """
+    Starts the given number of gateway processes and restarts them when they die.
+    The processes share the MQTT messages via shared subscriptions, so each message is handled exactly once.
+
+    Args:
+        processes (int): The number of gateway processes.
+    """
+
+    def start(index: int) -> multiprocessing.Process:
+        process = multiprocessing.Process(
+            target=run_gateway, args=(index,), name=f"gateway-{index}"
+        )
+        process.start()
+        logger.info("Started gateway process %d (pid %d)", index, process.pid)
+        return process
+
+    logger = setup_logging("mqtt-gateway", LOG_PATH, level=LOG_LEVEL, log_format=LOG_FORMAT)
+    # Terminate the children when the supervisor is stopped
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    children = {index: start(index) for index in range(processes)}
+    try:
         while True:
-            reconnect_interval = 5
-            try:
-                async with Client(hostname=MQTT_HOST) as client:
-                    tasks = [
-                        asyncio.create_task(self.mqtt_listener(client)),
-                        asyncio.create_task(self.redis_listener(client)),
-                        asyncio.create_task(self.start_workers(client)),
-                    ]
-                    await asyncio.gather(*tasks)
-            except MqttError as error:
-                print(
-                    f"MQTT error: {error} - reconnecting in {reconnect_interval} seconds"
-                )
-                await asyncio.sleep(reconnect_interval)
+            multiprocessing.connection.wait(
+                [process.sentinel for process in children.values()]
+            )
+            for index, process in list(children.items()):
+                if not process.is_alive():
+                    logger.error(
+                        "Gateway process %d exited with code %s - restarting in 5 seconds",
+                        index,
+                        process.exitcode,
+                    )
+                    time.sleep(5)
+                    children[index] = start(index)
+    finally:
+        for process in children.values():
+            process.terminate()
+        for process in children.values():
+            process.join()
 
 
 if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    gateway = MqttGateway()
-    asyncio.run(gateway.run())
+    if GATEWAY_PROCESSES > 1:
+        supervise(GATEWAY_PROCESSES)
+    else:
+        run_gateway()
@@ -0,0 +1,203 @@
+"""
+This module implements the logging pipeline of the MQTT IoT Gateway.
+Records are put into a queue by the event loop and formatted and written in batches by a background thread,
+so log I/O never blocks the event loop.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, TextIO, Tuple
+
+# Attributes every LogRecord has, everything else was passed as extra and is added to the structured record
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single line of JSON. Attributes passed via extra become fields of the record.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Formats a record as a line of text. The number of suppressed records is appended if there are any.
+    """
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += f" ({suppressed} similar messages suppressed)"
+        return line
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Samples records and limits the rate of records with the same message template, using a token bucket per template.
+    The number of records suppressed since the last one that was let through is added to it as the suppressed field.
+    Filters are only applied to records of enabled levels, so disabled levels cost nothing here either.
+    """
+
+    def __init__(self, sample_rate: float = 1, rate: float = 10, burst: Optional[float] = None):
+        """
+        Args:
+            sample_rate (float, optional): The fraction of records that are considered at all. Defaults to 1.
+            rate (float, optional): The number of records per second and template that are let through. Defaults to 10.
+            burst (float, optional): The number of records that are let through at once. Defaults to the rate.
+        """
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._buckets: Dict[str, Tuple[float, float, int]] = {}  # template -> (tokens, last update, suppressed)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        now = time.monotonic()
+        key = str(record.msg)
+        tokens, last, suppressed = self._buckets.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, suppressed + 1)
+            return False
+        if suppressed:
+            record.suppressed = suppressed
+        self._buckets[key] = (tokens - 1, now, 0)
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record stays in this process, so formatting can be left to the writer thread
+        return record
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread that takes records from the queue in batches, formats them and writes each batch
+    to every stream with a single write.
+    """
+
+    _STOP = None
+
+    def __init__(
+        self,
+        records: queue.SimpleQueue,
+        streams: List[TextIO],
+        formatter: logging.Formatter,
+        batch_size: int = 1000,
+    ):
+        super().__init__(name="log-writer", daemon=True)
+        self.records = records
+        self.streams = streams
+        self.formatter = formatter
+        self.batch_size = batch_size
+
+    def run(self) -> None:
+        stopped = False
+        while not stopped:
+            batch = [self.records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                if record is self._STOP:
+                    stopped = True
+                    continue
+                try:
+                    lines.append(self.formatter.format(record) + "\n")
+                except Exception:
+                    lines.append(f"Could not format log record {record.msg!r}\n")
+            if not lines:
+                continue
+            text = "".join(lines)
+            for stream in self.streams:
+                try:
+                    stream.write(text)
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
+
+    def stop(self) -> None:
+        """
+        Writes the remaining records and stops the thread.
+        """
+        self.records.put(self._STOP)
+        self.join()
+
+
+def setup_logging(
+    name: str,
+    path: Optional[str] = None,
+    level: str = "INFO",
+    log_format: str = "json",
+    message_sample_rate: float = 1,
+    message_rate: float = 10,
+) -> logging.Logger:
+    """
+    Configures the logger of the gateway to write to stderr and the log file through a background thread.
+    The child logger "<name>.messages" is meant for per-message events and is sampled and rate limited.
+    Calling this again, e.g. in a forked process, replaces the previous configuration.
+
+    Args:
+        name (str): The name of the logger.
+        path (str, optional): The path of the log file. Defaults to None, which only logs to stderr.
+        level (str, optional): The minimum level of records that are logged. Defaults to "INFO".
+        log_format (str, optional): Either "json" or "text". Defaults to "json".
+        message_sample_rate (float, optional): The fraction of per-message events that are logged. Defaults to 1.
+        message_rate (float, optional): The number of per-message events per second and template. Defaults to 10.
+
+    Returns:
+        logging.Logger: The configured logger.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    records = queue.SimpleQueue()
+    logger.addHandler(_QueueHandler(records))
+    streams = [sys.stderr]
+    if path:
+        streams.append(open(path, "a", buffering=1024 * 1024))
+    writer = LogWriter(
+        records, streams, JsonFormatter() if log_format == "json" else TextFormatter()
+    )
+    writer.start()
+    atexit.register(writer.stop)
+
+    messages = logger.getChild("messages")
+    for log_filter in list(messages.filters):
+        messages.removeFilter(log_filter)
+    messages.addFilter(RateLimitFilter(message_sample_rate, message_rate))
+    return logger
@@ -0,0 +1,80 @@
+"""
+This module defines the Prometheus metrics of the MQTT IoT Gateway.
+"""
+
+import os
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Per-topic labels are useful for small deployments but create one series per topic, so they are opt-in
+METRICS_PER_TOPIC = os.environ.get("METRICS_PER_TOPIC", "false").lower() == "true"
+
+
+def topic_label(topic: str) -> str:
+    """
+    Returns the value of the topic label, which is the same for all topics if METRICS_PER_TOPIC is disabled.
+    """
+    return topic if METRICS_PER_TOPIC else "all"
+
+
+MESSAGES_RECEIVED = Counter(
+    "gateway_messages_received_total", "MQTT messages received", ["topic"]
+)
+MESSAGES_FORWARDED = Counter(
+    "gateway_values_forwarded_total",
+    "Values extracted from MQTT messages and handed over to Orion",
+    ["topic"],
+)
+QUEUE_DEPTH = Gauge("gateway_queue_depth", "Messages waiting in the queue")
+QUEUE_DROPPED = Counter(
+    "gateway_queue_dropped_total", "MQTT messages dropped by the queue", ["policy"]
+)
+CONFIG_VERSION = Gauge(
+    "gateway_config_version", "Version of the configuration from the manage_topics stream applied by the gateway"
+)
+CONFIG_RESYNCS = Counter(
+    "gateway_config_resyncs_total", "Reloads of all topics after changes on the manage_topics stream were missed"
+)
+SUBSCRIPTIONS = Gauge("gateway_subscriptions", "Topic filters the gateway is subscribed to")
+ROUTE_CACHE = Counter(
+    "gateway_route_cache_total",
+    "Lookups in the in-memory routing table by result (hit or miss)",
+    ["result"],
+)
+REDIS_CACHE = Counter(
+    "gateway_redis_cache_total",
+    "Lookups of topics in the Redis cache by result (hit, miss or error)",
+    ["result"],
+)
+POSTGRES_FALLBACKS = Counter(
+    "gateway_postgres_fallbacks_total", "Topics looked up in Postgres"
+)
+ORION_REQUESTS = Histogram(
+    "gateway_orion_request_duration_seconds",
+    "Duration of requests to Orion by outcome (success, rejected or unavailable)",
+    ["outcome"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+ORION_ENTITIES = Counter(
+    "gateway_orion_entities_total", "Entities acknowledged by Orion"
+)
+ORION_BREAKER_OPEN = Gauge(
+    "gateway_orion_breaker_open", "Whether the circuit breaker around Orion is open"
+)
+DEAD_LETTERS = Counter(
+    "gateway_dead_letters_total", "Batches written to the dead-letter store", ["reason"]
+)
+SPOOLED = Counter("gateway_spooled_records_total", "Records written to the spool", ["kind"])
+ERRORS = Counter("gateway_errors_total", "Errors by component", ["component"])
+WORKERS = Gauge("gateway_workers", "Worker tasks")
+WORKERS_BUSY = Gauge("gateway_workers_busy", "Worker tasks currently processing a message")
+WORKER_BUSY_SECONDS = Counter(
+    "gateway_worker_busy_seconds_total",
+    "Time spent by the workers processing messages, divided by the number of workers this is the utilization",
+)
+STAGE_LATENCY = Histogram(
+    "gateway_stage_latency_seconds",
+    "Time spent by messages in each stage of the gateway (queue, routing, extraction, batching, orion) and in total",
+    ["stage"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
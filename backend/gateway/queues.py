@@ -0,0 +1,162 @@
+"""
+This module implements the queue between the listeners and the workers of the MQTT IoT Gateway.
+"""
+
+import asyncio
+import logging
+from collections import Counter, deque
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import QUEUE_DROPPED
+from tracing import Tracer
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class MessageQueue(asyncio.Queue):
+    """
+    Queue for storing incoming messages as (priority, source, message) tuples, where an MQTT message is a
+    (topic, payload, trace) tuple.
+    Control messages from Redis (priority 0) are always processed before MQTT messages (priority 1)
+    and are never dropped. MQTT messages are processed in the order they arrived and their number is
+    bounded by maxsize. When the queue is full, the policy decides what happens to a new message:
+
+    - drop-oldest: the oldest pending MQTT message is dropped to make room for the new one
+    - drop-newest: the new message is dropped
+    - block: the MQTT reader waits until a worker has taken a message from the queue. The subscriptions are QoS 0,
+      so the broker keeps sending in the meantime. The MQTT client buffers up to maxsize further messages and
+      drops the newest ones beyond that, which ClientBufferDrops counts as drops of this policy.
+
+    Messages of coalesced topics occupy at most one place in the queue, a newer payload supersedes
+    the pending one. The traces of dropped and superseded messages are released.
+    """
+
+    def __init__(self, maxsize: int = 0, policy: str = DROP_OLDEST, tracer: Optional[Tracer] = None):
+        """
+        Args:
+            maxsize (int, optional): The maximum number of pending MQTT messages, 0 means unbounded. Defaults to 0.
+            policy (str, optional): What to do with new messages when the queue is full. Defaults to "drop-oldest".
+            tracer (Tracer, optional): Releases the traces of messages that never reach a worker. Defaults to None.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, expected one of {POLICIES}")
+        # The queue itself is unbounded, the limit only applies to MQTT messages
+        super().__init__()
+        self.data_maxsize = maxsize
+        self.policy = policy
+        self.tracer = tracer
+        self.dropped = Counter()  # Number of dropped messages per policy
+        self.latest: Dict[str, Tuple[bytes, Any]] = {}  # Newest pending payload and trace of each coalesced topic
+        self._not_full = asyncio.Event()
+
+    def _init(self, maxsize: int) -> None:
+        self._control = deque()
+        self._data = deque()
+
+    def _put(self, item: Tuple[int, str, Any]) -> None:
+        if item[0] == 0:
+            self._control.append(item)
+        else:
+            self._data.append(item)
+
+    def _get(self) -> Tuple[int, str, Any]:
+        if self._control:
+            return self._control.popleft()
+        priority, source, (topic, payload, trace) = self._data.popleft()
+        if not self.data_full():
+            self._not_full.set()
+        if payload is None:
+            payload, trace = self.latest.pop(topic)
+        return priority, source, (topic, payload, trace)
+
+    def qsize(self) -> int:
+        return len(self._control) + len(self._data)
+
+    def empty(self) -> bool:
+        return not (self._control or self._data)
+
+    def data_full(self) -> bool:
+        """
+        Returns whether the maximum number of pending MQTT messages has been reached.
+        """
+        return 0 < self.data_maxsize <= len(self._data)
+
+    def put_control(self, message: Any) -> None:
+        """
+        Puts a control message from Redis into the queue.
+        """
+        self.put_nowait((0, "redis", message))
+
+    async def put_mqtt(
+        self,
+        topic: str,
+        payload: bytes,
+        coalesce: bool = False,
+        trace: Any = None,
+        policy: Optional[str] = None,
+    ) -> None:
+        """
+        Puts an MQTT message into the queue, applying the policy if the queue is full.
+
+        Args:
+            topic (str): The topic of the message.
+            payload (bytes): The payload of the message.
+            coalesce (bool, optional): Whether the payload supersedes a pending payload of the topic. Defaults to False.
+            trace (Trace, optional): The trace of the message. Defaults to None.
+            policy (str, optional): Overrides the policy of the queue for this message. Defaults to None.
+        """
+        policy = policy or self.policy
+        if coalesce and topic in self.latest:
+            _, superseded = self.latest[topic]
+            self.latest[topic] = (payload, trace)
+            self._release(superseded)
+            return
+
+        if self.data_full():
+            if policy == DROP_NEWEST:
+                self.dropped[DROP_NEWEST] += 1
+                QUEUE_DROPPED.labels(DROP_NEWEST).inc()
+                self._release(trace)
+                return
+            elif policy == DROP_OLDEST:
+                _, _, (oldest_topic, oldest_payload, oldest_trace) = self._data.popleft()
+                if oldest_payload is None:
+                    _, oldest_trace = self.latest.pop(oldest_topic)
+                self._release(oldest_trace)
+                self.dropped[DROP_OLDEST] += 1
+                QUEUE_DROPPED.labels(DROP_OLDEST).inc()
+                self.task_done()
+            else:
+                while self.data_full():
+                    self._not_full.clear()
+                    await self._not_full.wait()
+
+        if coalesce:
+            # Only the topic is queued, the worker picks up the newest payload
+            self.latest[topic] = (payload, trace)
+            payload = trace = None
+        self.put_nowait((1, "mqtt", (topic, payload, trace)))
+
+    def _release(self, trace: Any) -> None:
+        if self.tracer is not None and trace is not None:
+            self.tracer.release(trace)
+
+
+class ClientBufferDrops(logging.Filter):
+    """
+    Counts the messages the asyncio_mqtt client discards when its buffer is full. The client only reports them
+    with a warning on its logger, which this filter is attached to.
+    """
+
+    def __init__(self, queue: MessageQueue):
+        super().__init__()
+        self.queue = queue
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.getMessage().startswith("Message queue is full"):
+            self.queue.dropped[BLOCK] += 1
+            QUEUE_DROPPED.labels(BLOCK).inc()
+        return True
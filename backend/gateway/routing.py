@@ -0,0 +1,144 @@
+"""
+This module implements the in-process routing of MQTT topics to datapoints.
+"""
+
+import os
+from functools import lru_cache
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from jsonpath_ng import parse
+from paho.mqtt.client import topic_matches_sub
+
+JSONPATH_CACHE_SIZE = int(os.environ.get("JSONPATH_CACHE_SIZE", 4096))
+# Topic filters (e.g. "sensors/+/temperature") whose messages are coalesced, separated by commas
+COALESCE_TOPICS = [
+    topic.strip()
+    for topic in os.environ.get("COALESCE_TOPICS", "").split(",")
+    if topic.strip()
+]
+
+
+@lru_cache(maxsize=JSONPATH_CACHE_SIZE)
+def compile_jsonpath(expression: str):
+    """
+    Returns the compiled JSONPath expression for the given string.
+    Parsing the JSONPath grammar is expensive, so compiled expressions are kept in an LRU registry
+    keyed by the expression string and shared by all workers.
+
+    Args:
+        expression (str): The JSONPath expression, e.g. "$..temperature".
+    """
+    return parse(expression)
+
+
+@lru_cache(maxsize=65536)
+def is_coalesced(topic: str) -> bool:
+    """
+    Returns whether only the newest pending message of the topic is processed.
+    This is the case if the topic matches one of the filters in COALESCE_TOPICS.
+
+    Args:
+        topic (str): The MQTT topic of the message.
+    """
+    return any(topic_matches_sub(sub, topic) for sub in COALESCE_TOPICS)
+
+
+class Route(NamedTuple):
+    """
+    A pre-parsed datapoint as it is used on the hot path of the gateway.
+    """
+
+    object_id: str
+    jsonpath: str
+    expression: Any  # compiled JSONPath expression
+    entity_id: Optional[str]
+    entity_type: Optional[str]
+    attribute_name: Optional[str]
+    coalesce: bool  # Whether a pending value may be superseded by a newer one
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> "Route":
+        """
+        Creates a route from a datapoint record as it is stored in Redis or Postgres.
+
+        Args:
+            record (Dict[str, Any]): The datapoint record.
+        """
+        return cls(
+            object_id=record["object_id"],
+            jsonpath=record["jsonpath"],
+            expression=compile_jsonpath(record["jsonpath"]),
+            entity_id=record.get("entity_id"),
+            entity_type=record.get("entity_type"),
+            attribute_name=record.get("attribute_name"),
+            coalesce=bool(record.get("coalesce_updates")),
+        )
+
+    @property
+    def matched(self) -> bool:
+        """
+        Whether the datapoint is matched to an entity/attribute pair in the Context Broker.
+        """
+        return bool(self.entity_id and self.attribute_name)
+
+
+class RoutingTable:
+    """
+    Maps topics to the routes of their datapoints.
+    Topics are loaded lazily (Redis and Postgres are only the cold-start source) and are kept in sync
+    by invalidating them whenever the API announces a change on the manage_topics stream.
+    A topic without datapoints is stored as an empty tuple, so unknown topics do not hit the backends either.
+    """
+
+    def __init__(self):
+        self._routes: Dict[str, Tuple[Route, ...]] = {}
+        # Incremented on every invalidation. A load that started before an invalidation
+        # is not stored, as it may contain stale datapoints.
+        self.epoch = 0
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def get(self, topic: str) -> Optional[Tuple[Route, ...]]:
+        """
+        Returns the routes of the topic or None if the topic has not been loaded yet.
+        """
+        return self._routes.get(topic)
+
+    def set(
+        self, topic: str, records: Iterable[Dict[str, Any]], epoch: int
+    ) -> Tuple[Route, ...]:
+        """
+        Stores the routes of the topic built from the given datapoint records.
+
+        Args:
+            topic (str): The MQTT topic.
+            records (Iterable[Dict[str, Any]]): The datapoint records of the topic.
+            epoch (int): The epoch of the table when the records were loaded.
+
+        Returns:
+            Tuple[Route, ...]: The routes of the topic.
+        """
+        routes = tuple(Route.from_record(record) for record in records)
+        if epoch == self.epoch:
+            self._routes[topic] = routes
+        return routes
+
+    def invalidate(self, topic: str) -> None:
+        """
+        Drops the routes of the topic. They are reloaded on the next message.
+        If the topic is a wildcard topic, the routes of all topics it matches are dropped.
+        """
+        if "+" in topic or "#" in topic:
+            for cached in [cached for cached in self._routes if topic_matches_sub(topic, cached)]:
+                del self._routes[cached]
+        else:
+            self._routes.pop(topic, None)
+        self.epoch += 1
+
+    def clear(self) -> None:
+        """
+        Drops all routes.
+        """
+        self._routes.clear()
+        self.epoch += 1
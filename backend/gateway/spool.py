@@ -0,0 +1,169 @@
+"""
+This module implements the on-disk spool that buffers data while the downstream services are unavailable.
+"""
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Tuple
+
+Position = Tuple[int, int]  # (segment number, offset in the segment)
+
+
+class Spool:
+    """
+    Segmented, append-only log on disk. Records are appended as JSON lines to the newest segment through a
+    buffered file, and a new segment is started once it exceeds the segment size. A cursor file remembers how far
+    the log has been drained, so spooled records survive a restart. Segments are deleted once they are drained.
+    A line that was only partially written before a crash is skipped.
+
+    Records are appended on the event loop, while flush(), read() and commit() may run in a worker thread. A lock
+    guards the current segment and the positions, the slow file operations run outside of it.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 16 * 1024 * 1024):
+        """
+        Args:
+            directory (str): The directory of the segments.
+            segment_size (int, optional): The size in bytes after which a new segment is started. Defaults to 16 MiB.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.cursor_path = os.path.join(directory, "cursor")
+
+        segments = self.segments()
+        self.write_segment = segments[-1] if segments else 0
+        self.read_position = self._load_cursor(segments[0] if segments else 0)
+        self._file = open(self._path(self.write_segment), "ab")
+        self._lock = threading.Lock()
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}.log")
+
+    def segments(self) -> List[int]:
+        """
+        Returns the numbers of all segments on disk in ascending order.
+        """
+        return sorted(
+            int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log")
+        )
+
+    def _load_cursor(self, first_segment: int) -> Position:
+        try:
+            with open(self.cursor_path) as file:
+                segment, offset = json.load(file)
+                return segment, offset
+        except (OSError, ValueError):
+            return first_segment, 0
+
+    def append(self, record: Dict[str, Any]) -> None:
+        """
+        Appends a record to the log. The record is buffered until the next flush().
+
+        Args:
+            record (Dict[str, Any]): A JSON serializable record.
+        """
+        line = json.dumps(record).encode() + b"\n"
+        with self._lock:
+            self._file.write(line)
+            if self._file.tell() >= self.segment_size:
+                self._file.close()
+                self.write_segment += 1
+                self._file = open(self._path(self.write_segment), "ab")
+
+    def flush(self) -> None:
+        """
+        Writes the buffered records to disk.
+        """
+        with self._lock:
+            self._file.flush()
+            # The segment may be rotated during the fsync, the duplicate keeps its descriptor open
+            fd = os.dup(self._file.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def pending(self) -> bool:
+        """
+        Returns whether there are records that have not been drained yet.
+        """
+        with self._lock:
+            segment, offset = self.read_position
+            return segment < self.write_segment or offset < self._file.tell()
+
+    def read(self, max_records: int) -> List[Tuple[Dict[str, Any], Position]]:
+        """
+        Reads up to max_records records from the current read position. The position is only advanced by commit().
+
+        Args:
+            max_records (int): The maximum number of records.
+
+        Returns:
+            List[Tuple[Dict[str, Any], Position]]: The records, each with the position right after it.
+        """
+        with self._lock:
+            self._file.flush()
+            write_segment = self.write_segment
+            segment, offset = self.read_position
+        records = []
+        while len(records) < max_records:
+            try:
+                with open(self._path(segment), "rb") as file:
+                    file.seek(offset)
+                    for line in file:
+                        if not line.endswith(b"\n"):
+                            break  # Still being written
+                        offset += len(line)
+                        try:
+                            records.append((json.loads(line), (segment, offset)))
+                        except ValueError:
+                            continue
+                        if len(records) >= max_records:
+                            break
+            except FileNotFoundError:
+                pass
+            if len(records) >= max_records or segment >= write_segment:
+                break
+            segment, offset = segment + 1, 0
+        return records
+
+    def commit(self, position: Position) -> None:
+        """
+        Stores the read position and deletes all segments before it.
+
+        Args:
+            position (Position): The position of a record returned by read().
+        """
+        segment, offset = position
+        with self._lock:
+            write_segment = self.write_segment
+        # A position at the end of a finished segment is the start of the next one
+        while segment < write_segment and offset >= self._size(segment):
+            segment, offset = segment + 1, 0
+        position = (segment, offset)
+        temp_path = f"{self.cursor_path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(list(position), file)
+        os.replace(temp_path, self.cursor_path)
+        with self._lock:
+            self.read_position = position
+        for segment in self.segments():
+            if segment >= position[0]:
+                break
+            os.remove(self._path(segment))
+
+    def _size(self, segment: int) -> int:
+        try:
+            return os.path.getsize(self._path(segment))
+        except FileNotFoundError:
+            return 0
+
+    def close(self) -> None:
+        """
+        Flushes and closes the current segment.
+        """
+        self.flush()
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,395 @@
+"""
+This module implements the MQTT topic filters of the MQTT IoT Gateway: a trie for matching topics against
+many filters and the planning of the subscriptions that cover the topics of the datapoints.
+The topic of a datapoint may itself be a filter with the wildcards + and #.
+"""
+
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+
+def is_wildcard(topic: str) -> bool:
+    """
+    Returns whether the topic is a filter with wildcards.
+    """
+    return "+" in topic or "#" in topic
+
+
+def covers(outer: str, inner: str) -> bool:
+    """
+    Returns whether every topic matched by the inner filter is also matched by the outer filter.
+    A topic without wildcards is a filter that only matches itself.
+    """
+    outer_levels = outer.split("/")
+    inner_levels = inner.split("/")
+    for i, level in enumerate(outer_levels):
+        if level in ("+", "#") and i == 0 and inner_levels[0].startswith("$"):
+            return False
+        if level == "#":
+            return True
+        if i >= len(inner_levels):
+            return False
+        if level == "+":
+            if inner_levels[i] == "#":
+                return False
+        elif level != inner_levels[i]:
+            return False
+    return len(outer_levels) == len(inner_levels)
+
+
+class _Node:
+    __slots__ = ("children", "value", "has_value", "size")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.value: Any = None
+        self.has_value = False
+        self.size = 0  # Number of filters in the subtree
+
+
+class TopicTrie:
+    """
+    Maps MQTT topic filters to values with one trie level per topic level.
+    Finding the filters that match a topic takes time proportional to the number of levels of the topic,
+    not to the number of filters. Filters may contain the wildcards + and #.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+
+    def __len__(self) -> int:
+        return self._root.size
+
+    def __contains__(self, topic_filter: str) -> bool:
+        node = self._find(topic_filter)
+        return node is not None and node.has_value
+
+    def _find(self, topic_filter: str) -> Optional[_Node]:
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node
+
+    def get(self, topic_filter: str, default: Any = None) -> Any:
+        """
+        Returns the value of the filter itself, without matching wildcards.
+        """
+        node = self._find(topic_filter)
+        return node.value if node is not None and node.has_value else default
+
+    def insert(self, topic_filter: str, value: Any) -> None:
+        """
+        Stores the value of the filter, replacing a previous value.
+        """
+        levels = topic_filter.split("/")
+        path = [self._root]
+        for level in levels:
+            path.append(path[-1].children.setdefault(level, _Node()))
+        if not path[-1].has_value:
+            for node in path:
+                node.size += 1
+        path[-1].value = value
+        path[-1].has_value = True
+
+    def remove(self, topic_filter: str) -> Any:
+        """
+        Removes the filter and returns its value, or None if it was not stored.
+        """
+        levels = topic_filter.split("/")
+        path = [self._root]
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return None
+            path.append(node)
+        if not path[-1].has_value:
+            return None
+        value = path[-1].value
+        path[-1].value = None
+        path[-1].has_value = False
+        for node in path:
+            node.size -= 1
+        # Prune the nodes that no longer lead to a filter
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if node.size:
+                break
+            del parent.children[level]
+        return value
+
+    def match(self, topic: str) -> List[Any]:
+        """
+        Returns the values of all filters that match the topic.
+        As in MQTT, wildcards at the first level do not match topics starting with $.
+
+        Args:
+            topic (str): An MQTT topic without wildcards.
+        """
+        values = []
+        nodes = [self._root]
+        for i, level in enumerate(topic.split("/")):
+            wildcards = i > 0 or not level.startswith("$")
+            matched = []
+            for node in nodes:
+                children = node.children
+                if wildcards:
+                    multi = children.get("#")
+                    if multi is not None and multi.has_value:
+                        values.append(multi.value)
+                    single = children.get("+")
+                    if single is not None:
+                        matched.append(single)
+                child = children.get(level)
+                if child is not None:
+                    matched.append(child)
+            nodes = matched
+            if not nodes:
+                return values
+        for node in nodes:
+            if node.has_value:
+                values.append(node.value)
+            # "a/#" also matches "a"
+            multi = node.children.get("#")
+            if multi is not None and multi.has_value:
+                values.append(multi.value)
+        return values
+
+    def overlapping(self, topic_filter: str) -> List[Any]:
+        """
+        Returns the values of all stored filters that match a topic which is also matched by the given filter.
+        """
+        values = []
+        self._overlapping(self._root, topic_filter.split("/"), 0, values)
+        return values
+
+    def _overlapping(self, node: _Node, levels: List[str], i: int, values: List[Any]) -> None:
+        multi = node.children.get("#")
+        if multi is not None and multi.has_value:
+            values.append(multi.value)
+        if i == len(levels):
+            if node.has_value:
+                values.append(node.value)
+            return
+        level = levels[i]
+        if level == "#":
+            self._collect(node, values, skip="#")
+            return
+        if level == "+":
+            candidates = [child for key, child in node.children.items() if key != "#"]
+        else:
+            candidates = [node.children.get(level), node.children.get("+")]
+        for child in candidates:
+            if child is not None:
+                self._overlapping(child, levels, i + 1, values)
+
+    def _collect(self, node: _Node, values: List[Any], skip: Optional[str] = None) -> None:
+        if node.has_value:
+            values.append(node.value)
+        for key, child in node.children.items():
+            if key != skip:
+                self._collect(child, values)
+
+    def overlaps(self, topic_filter: str) -> bool:
+        """
+        Returns whether a topic exists that is matched by both the given filter and one of the stored filters.
+        """
+        return self._overlaps(self._root, topic_filter.split("/"), 0)
+
+    def _overlaps(self, node: _Node, levels: List[str], i: int) -> bool:
+        if i == len(levels):
+            multi = node.children.get("#")
+            return node.has_value or (multi is not None and multi.has_value)
+        level = levels[i]
+        if level == "#":
+            return node.size > 0
+        multi = node.children.get("#")
+        if multi is not None and multi.has_value:
+            return True
+        if level == "+":
+            candidates = [child for key, child in node.children.items() if key != "#"]
+        else:
+            candidates = [node.children.get(level), node.children.get("+")]
+        return any(
+            self._overlaps(child, levels, i + 1) for child in candidates if child is not None
+        )
+
+
+class SubscriptionPlan:
+    """
+    Decides which topic filters the gateway subscribes to in order to receive the messages of its topics.
+    Without compaction, every topic is subscribed to on its own. With compaction, a group of at least
+    min_group topics that only differ in a single level is covered by one filter with a + wildcard in
+    that level instead, e.g. "sensors/building1/+/temp" for all rooms of building1. A wildcard filter also
+    delivers the messages of topics without datapoints, which the gateway drops.
+
+    Wildcard topics of datapoints are subscribed to as they are and take over the filters they cover.
+    Filters do not overlap, so no message is delivered twice. The only exception are two wildcard topics of
+    datapoints that partially overlap, e.g. "a/+/c" and "a/b/#", which the broker may both deliver messages to.
+
+    New topics are covered by an existing filter if one covers them, the others are planned as a group.
+    A filter is unsubscribed once none of its topics are left. When a wildcard topic of a datapoint is removed,
+    the topics it took over are planned again.
+    """
+
+    def __init__(self, min_group: int = 0):
+        """
+        Args:
+            min_group (int, optional): The minimum number of topics that are covered by a wildcard filter,
+                0 disables compaction. Defaults to 0.
+        """
+        self.min_group = min_group
+        self._filters = TopicTrie()  # filter -> filter, to find the filters matching a topic
+        self._covered: Dict[str, Set[str]] = {}  # filter -> covered topics
+        self._covering: Dict[str, str] = {}  # topic -> filter
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self._covering
+
+    def __len__(self) -> int:
+        return len(self._covered)
+
+    @property
+    def topics(self) -> Set[str]:
+        """
+        The topics covered by the subscriptions.
+        """
+        return set(self._covering)
+
+    def _cover(self, topic_filter: str, topics: Iterable[str]) -> None:
+        covered = self._covered.get(topic_filter)
+        if covered is None:
+            covered = self._covered[topic_filter] = set()
+            self._filters.insert(topic_filter, topic_filter)
+        for topic in topics:
+            covered.add(topic)
+            self._covering[topic] = topic_filter
+
+    def add(self, topics: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """
+        Covers the given topics.
+
+        Returns:
+            Tuple[List[str], List[str]]: The filters that have to be subscribed to and the filters that are
+                replaced by them and have to be unsubscribed from once the new subscriptions are in place.
+        """
+        # Dicts keep the order, a filter that is replaced and planned again in the same call cancels out
+        new_filters: Dict[str, None] = {}
+        replaced: Dict[str, None] = {}
+
+        def subscribe(topic_filter: str, topics: Iterable[str]) -> None:
+            self._cover(topic_filter, topics)
+            if topic_filter in replaced:
+                del replaced[topic_filter]  # Still subscribed
+            else:
+                new_filters[topic_filter] = None
+
+        def unsubscribe(topic_filter: str) -> None:
+            if topic_filter in new_filters:
+                del new_filters[topic_filter]  # Not subscribed yet
+            else:
+                replaced[topic_filter] = None
+
+        # Wildcard topics are placed first, so the exact topics can be covered by them
+        wildcards = [topic for topic in topics if is_wildcard(topic)]
+        exact = [topic for topic in topics if not is_wildcard(topic)]
+        while wildcards:
+            topic = wildcards.pop()
+            if topic in self._covering:
+                continue
+            overlapping = self._filters.overlapping(topic)
+            outer = next((f for f in overlapping if covers(f, topic)), None)
+            if outer is not None:
+                self._cover(outer, [topic])
+                continue
+            # Take over the filters the topic covers and break up compacted filters it overlaps
+            for topic_filter in overlapping:
+                if covers(topic, topic_filter) or topic_filter not in self._covered[topic_filter]:
+                    unsubscribe(topic_filter)
+                    for member in self.drop(topic_filter):
+                        (wildcards if is_wildcard(member) else exact).append(member)
+            subscribe(topic, [topic])
+
+        pending = []
+        for topic in exact:
+            if topic in self._covering:
+                continue
+            existing = self._filters.match(topic)
+            if existing:
+                # Only wildcard topics of datapoints may overlap, any of them will do
+                self._cover(existing[0], [topic])
+            else:
+                pending.append(topic)
+
+        if self.min_group > 1 and len(pending) >= self.min_group:
+            for wildcard, members in self._groups(pending):
+                members = [topic for topic in members if topic not in self._covering]
+                if len(members) < self.min_group or self._filters.overlaps(wildcard):
+                    continue
+                subscribe(wildcard, members)
+        for topic in pending:
+            if topic not in self._covering:
+                subscribe(topic, [topic])
+        return list(new_filters), list(replaced)
+
+    @staticmethod
+    def _groups(topics: List[str]) -> List[Tuple[str, List[str]]]:
+        """
+        Returns the wildcard filters with a single + that match at least two of the topics, largest first.
+        """
+        groups = defaultdict(list)
+        for topic in topics:
+            levels = topic.split("/")
+            for i in range(len(levels)):
+                groups["/".join(levels[:i] + ["+"] + levels[i + 1 :])].append(topic)
+        return sorted(
+            ((wildcard, members) for wildcard, members in groups.items() if len(members) > 1),
+            key=lambda group: len(group[1]),
+            reverse=True,
+        )
+
+    def remove(self, topics: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """
+        Stops covering the given topics.
+
+        Returns:
+            Tuple[List[str], List[str]]: The filters that have to be subscribed to for the topics that were covered
+                by a removed wildcard topic, and the filters that have to be unsubscribed from once the new
+                subscriptions are in place.
+        """
+        topics = dict.fromkeys(topics)  # Keeps the order of the topics
+        unused = []
+        orphaned = set()  # Topics that were covered by a removed wildcard topic
+        for topic in topics:
+            topic_filter = self._covering.pop(topic, None)
+            if topic_filter is None:
+                continue
+            covered = self._covered[topic_filter]
+            covered.discard(topic)
+            if not covered or topic == topic_filter:
+                orphaned |= self.drop(topic_filter)
+                unused.append(topic_filter)
+
+        new_filters, replaced = self.add([topic for topic in orphaned if topic not in topics])
+        # A filter that is planned again stays subscribed
+        unsubscribe = [topic_filter for topic_filter in unused + replaced if topic_filter not in new_filters]
+        new_filters = [topic_filter for topic_filter in new_filters if topic_filter not in unused]
+        return new_filters, unsubscribe
+
+    def drop(self, topic_filter: str) -> Set[str]:
+        """
+        Forgets a filter whose subscription failed and returns the topics it was meant to cover.
+        """
+        self._filters.remove(topic_filter)
+        covered = self._covered.pop(topic_filter, set())
+        for topic in covered:
+            self._covering.pop(topic, None)
+        return covered
+
+    def clear(self) -> None:
+        """
+        Forgets all subscriptions, e.g. after a reconnect.
+        """
+        self._filters = TopicTrie()
+        self._covered.clear()
+        self._covering.clear()
@@ -0,0 +1,122 @@
+"""
+This module implements the tracing of MQTT messages through the stages of the MQTT IoT Gateway.
+"""
+
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+from metrics import STAGE_LATENCY
+
+# The stages of a message in the order they are passed
+STAGES = ("received", "dequeued", "routed", "extracted", "sent", "acknowledged")
+# The name of the latency between a stage and the one before it
+INTERVALS = {
+    "dequeued": "queue",
+    "routed": "routing",
+    "extracted": "extraction",
+    "sent": "batching",
+    "acknowledged": "orion",
+}
+
+
+class Trace:
+    """
+    The timestamps of a single MQTT message at the stages of the gateway.
+    The values of a message may be sent to Orion in several batches, the trace is finished once the last one is done.
+    """
+
+    __slots__ = ("topic", "timestamps", "time", "sampled", "pending")
+
+    def __init__(self, topic: str, sampled: bool = False):
+        self.topic = topic
+        self.timestamps: Dict[str, float] = {"received": time.perf_counter()}
+        self.time = time.time() if sampled else None  # Wall clock time of receipt for the trace file
+        self.sampled = sampled
+        # Number of holders of the trace, i.e. the worker processing the message and the batches with its values
+        self.pending = 1
+
+    def mark(self, stage: str) -> None:
+        """
+        Records that the message has reached the stage. Only the first time a stage is reached counts.
+        """
+        self.timestamps.setdefault(stage, time.perf_counter())
+
+
+class Tracer:
+    """
+    Creates the traces of incoming messages and records the latency between their stages in the
+    gateway_stage_latency_seconds histogram. A sample of the traces is also written to a file, one JSON record
+    per line with the time of receipt and the time in milliseconds at which each stage was reached.
+    """
+
+    def __init__(self, path: Optional[str] = None, sample_rate: float = 0):
+        """
+        Args:
+            path (str, optional): The path of the trace file. Defaults to None, which writes no traces.
+            sample_rate (float, optional): The fraction of messages whose trace is written. Defaults to 0.
+        """
+        self.path = path
+        self.sample_rate = sample_rate if path else 0
+        self._buffer: List[str] = []
+
+    def start(self, topic: str) -> Trace:
+        """
+        Starts the trace of a message that has just been received.
+        """
+        return Trace(topic, self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def release(self, trace: Trace) -> None:
+        """
+        Releases a hold on the trace and finishes it once the last holder has released it.
+        """
+        trace.pending -= 1
+        if trace.pending == 0:
+            self.finish(trace)
+
+    def finish(self, trace: Trace) -> None:
+        """
+        Records the latencies of a trace whose message has left the gateway.
+        A message that did not reach all stages, e.g. because it had no datapoints, is recorded up to the last one.
+        """
+        timestamps = trace.timestamps
+        previous = timestamps["received"]
+        for stage, interval in INTERVALS.items():
+            timestamp = timestamps.get(stage)
+            if timestamp is None:
+                continue
+            STAGE_LATENCY.labels(interval).observe(timestamp - previous)
+            previous = timestamp
+        if "acknowledged" in timestamps:
+            STAGE_LATENCY.labels("total").observe(timestamps["acknowledged"] - timestamps["received"])
+        if trace.sampled:
+            self._buffer.append(self._record(trace))
+
+    @staticmethod
+    def _record(trace: Trace) -> str:
+        received = trace.timestamps["received"]
+        record: Dict[str, Any] = {"time": trace.time, "topic": trace.topic}
+        record.update(
+            {
+                stage: round((trace.timestamps[stage] - received) * 1000, 3)
+                for stage in STAGES[1:]
+                if stage in trace.timestamps
+            }
+        )
+        return json.dumps(record)
+
+    def _write(self, lines: List[str]) -> None:
+        with open(self.path, "a") as file:
+            file.write("\n".join(lines) + "\n")
+
+    async def run(self) -> None:
+        """
+        Writes the sampled traces to the trace file once per second. Runs until cancelled.
+        """
+        while True:
+            await asyncio.sleep(1)
+            if self._buffer:
+                lines, self._buffer = self._buffer, []
+                await asyncio.to_thread(self._write, lines)
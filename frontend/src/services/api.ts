@@ -10,6 +10,7 @@ export interface Datapoint {
     entity_type: string | null; // Can be a string or null
     attribute_name: string | null; // Can be a string or null
     matchDatapoint: boolean;
+    coalesce_updates?: boolean; // Only forward the newest pending value
     status?: string | boolean | null; // Can be a string, boolean, or null
 }
 
@@ -19,6 +20,7 @@ export interface DatapointUpdate {
     entity_type?: string;
     attribute_name?: string;
     description?: string;
+    coalesce_updates?: boolean;
 }
 
 export interface SystemStatus {
@@ -28,14 +30,25 @@ export interface SystemStatus {
 }
 
 
-export const fetchData = async (): Promise<Datapoint[]> => {
-    const response: Response = await fetch(`${API_HOST}/data`);
-    const responseData = await response.json();
-    let data: Datapoint[] = await Promise.all(responseData.map(async row => {
-        row.status = await getStatus(row.object_id);
-        return row;
-      }));
-    return data;
+export interface DatapointPage {
+    datapoints: Datapoint[];
+    next: string | null; // The cursor of the next page, null on the last page
+}
+
+export const PAGE_SIZE = 100;
+
+export const fetchData = async (after?: string): Promise<DatapointPage> => {
+    // the datapoints are returned page by page together with their match status
+    const params = new URLSearchParams({ limit: String(PAGE_SIZE) });
+    if (after) {
+        params.set('after', after);
+    }
+    const response: Response = await fetch(`${API_HOST}/data/status?${params}`);
+    if (!response.ok) {
+        throw new Error(`Failed to fetch datapoints`);
+    }
+    const responseData: Datapoint[] = await response.json();
+    return { datapoints: responseData, next: response.headers.get('X-Next-After') };
 };
 
 export const addData = async (data: Datapoint) => {
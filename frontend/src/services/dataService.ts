@@ -1,10 +1,27 @@
-import { data } from '../stores/stores';
+import { get } from 'svelte/store';
+import { data, nextPage } from '../stores/stores';
 import { fetchData } from './api';
 
 export async function refreshData(): Promise<void> {
   try {
-    data.set(await fetchData());
+    const page = await fetchData();
+    data.set(page.datapoints);
+    nextPage.set(page.next);
   } catch (e) {
     console.error('An error occurred while fetching the data:', e);
   }
-}
\ No newline at end of file
+}
+
+export async function loadMoreData(): Promise<void> {
+  const after = get(nextPage);
+  if (!after) {
+    return;
+  }
+  try {
+    const page = await fetchData(after);
+    data.update(rows => [...rows, ...page.datapoints]);
+    nextPage.set(page.next);
+  } catch (e) {
+    console.error('An error occurred while fetching the data:', e);
+  }
+}
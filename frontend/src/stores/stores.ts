@@ -2,6 +2,7 @@ import { writable } from "svelte/store";
 import type { Datapoint, DatapointUpdate } from "../services/api";
 
 export const data = writable<Datapoint[]>([]);
+export const nextPage = writable<string | null>(null); // cursor of the next page of datapoints
 export const currentlyEditing = writable<string | null>(null);
 export const tempData = writable<DatapointUpdate | null>(null);
 export const newDatapoint = writable<Datapoint | null>(null);
\ No newline at end of file
@@ -2,6 +2,7 @@ import asyncio
 import json
 import sys
 from collections import defaultdict
+from typing import List, Tuple
 from uuid import uuid4
 
 import aiohttp
@@ -46,28 +47,29 @@ last_message_received = asyncio.Event()
 generate_messages = asyncio.Event()
 
 
-async def register_datapoint(
+async def register_datapoints(
     session: aiohttp.ClientSession,
-    entity_id: str,
-    entity_type: str,
-    attribute_name: str,
+    entities: List[Tuple[str, str, str, str]],
 ) -> None:
     """
-    Register a new datapoint for the given entity in the gateway using the API.
+    Register a new datapoint for each of the given entities in the gateway with a single request to the bulk API.
     """
 
     await session.post(
-        f"{GATEWAY_URL}/data",
-        json={
-            "object_id": str(uuid4()),
-            "jsonpath": f"$..{attribute_name}",
-            "topic": f"test/{entity_id}",
-            "description": "Test",
-            "entity_id": entity_id,
-            "entity_type": entity_type,
-            "attribute_name": attribute_name,
-            "matchDatapoint": True,
-        },
+        f"{GATEWAY_URL}/data/bulk",
+        json=[
+            {
+                "object_id": str(uuid4()),
+                "jsonpath": f"$..{attribute_name}",
+                "topic": f"test/{entity_id}",
+                "description": "Test",
+                "entity_id": entity_id,
+                "entity_type": entity_type,
+                "attribute_name": attribute_name,
+                "matchDatapoint": True,
+            }
+            for _, entity_id, entity_type, attribute_name in entities
+        ],
     )
 
 
@@ -102,17 +104,16 @@ async def receive_mqtt_notification() -> None:
                 latencies[stage].append(latency)
 
 
-async def generate_client() -> None:
+async def generate_client(entity: Tuple[str, str, str, str]) -> None:
     """
     Generate a client and publish a payload to the test/latency topic every second.
     The client continuously publishes a payload every second until it is cancelled. Each payload consists of
     a real and a fake attribute and a timestamp. The real attribute is used to test whether the matching works
-    properly, while the timestamp is used to calculate the latency.
+    properly, while the timestamp is used to calculate the latency. The datapoint of the entity has already been registered.
     """
     try:
-        device_id, entity_id, entity_type, attribute_name = await generate_entity()
+        device_id, entity_id, entity_type, attribute_name = entity
         async with aiohttp.ClientSession() as session:
-            await register_datapoint(session, entity_id, entity_type, attribute_name)
             await register_entity(session, entity_id, entity_type, attribute_name)
             await generate_subscription(session, entity_id, entity_type, attribute_name)
         async with MQTTClient(mqtt_broker_address) as client:
@@ -152,8 +153,12 @@ async def generate_clients(
             print(f"Stage {stage}")
             generate_messages.set()
             messages_per_second[stage] = client_step * (stage + 1)
+            # the datapoints of all clients of the stage are registered at once
+            entities = [await generate_entity() for _ in range(client_step)]
+            async with aiohttp.ClientSession() as session:
+                await register_datapoints(session, entities)
             new_tasks = [
-                asyncio.create_task(generate_client()) for _ in range(client_step)
+                asyncio.create_task(generate_client(entity)) for entity in entities
             ]
             tasks.extend(new_tasks)
             await asyncio.sleep(creation_interval)
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "gateway"))
+
+from forwarding import CircuitBreaker, DeadLetterStore, OrionBatcher, OrionError
+
+
+class RecordingBatcher(OrionBatcher):
+    """
+    Batcher that records the requests instead of sending them to Orion. Requests wait until release is set.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(url="http://orion", headers={}, logger=logging.getLogger("test"), **kwargs)
+        self.sent = []
+        self.release = asyncio.Event()
+        self.release.set()
+        self.failures = 0  # Number of requests that fail before Orion is available
+
+    async def send(self, entities):
+        await self.release.wait()
+        if self.failures:
+            self.failures -= 1
+            raise OrionError("Orion is unavailable")
+        self.sent.append(entities)
+
+    async def drain(self):
+        await self.flush()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+
+
+def values(sent):
+    """
+    Returns the attribute values in the order they were sent, as (entity_id, attribute, value) tuples.
+    """
+    return [
+        (entity["id"], name, attr["value"])
+        for entities in sent
+        for entity in entities
+        for name, attr in entity.items()
+        if name not in ("id", "type")
+    ]
+
+
+class TestOrionBatcher(unittest.IsolatedAsyncioTestCase):
+    """
+    Test for the batching of attribute updates
+    """
+
+    async def test_merge(self):
+        batcher = RecordingBatcher()
+        await batcher.submit("e1", "T", "a", 1)
+        await batcher.submit("e1", "T", "b", 2)
+        await batcher.submit("e2", None, "a", 3)
+        await batcher.drain()
+        self.assertEqual(len(batcher.sent), 1)
+        self.assertEqual(values(batcher.sent), [("e1", "a", 1), ("e1", "b", 2), ("e2", "a", 3)])
+        self.assertNotIn("type", batcher.sent[0][1])
+
+    async def test_pending_value_is_not_overwritten(self):
+        batcher = RecordingBatcher()
+        await batcher.submit("e1", "T", "a", 1)
+        await batcher.submit("e1", "T", "a", 2)
+        await batcher.drain()
+        self.assertEqual(values(batcher.sent), [("e1", "a", 1), ("e1", "a", 2)])
+
+    async def test_coalesce(self):
+        batcher = RecordingBatcher()
+        await batcher.submit("e1", "T", "a", 1, coalesce=True)
+        await batcher.submit("e1", "T", "a", 2, coalesce=True)
+        await batcher.drain()
+        self.assertEqual(values(batcher.sent), [("e1", "a", 2)])
+
+    async def test_max_entities(self):
+        batcher = RecordingBatcher(max_entities=2)
+        for i in range(5):
+            await batcher.submit(f"e{i}", "T", "a", i)
+        await batcher.drain()
+        self.assertEqual([len(entities) for entities in batcher.sent], [2, 2, 1])
+
+    async def test_concurrent_submit_while_flushing(self):
+        # Updates added by other workers while a flush waits for a slot must not be lost
+        batcher = RecordingBatcher(max_entities=1, max_in_flight=1)
+        batcher.release.clear()
+        await batcher.submit("e1", "T", "a", 1)
+        await batcher.submit("e2", "T", "a", 2)  # Flushes e1, which takes the only slot
+        first = asyncio.create_task(batcher.submit("e3", "T", "a", 3))  # Flushes e2 and waits for the slot
+        await asyncio.sleep(0)
+        second = asyncio.create_task(batcher.submit("e3", "T", "b", 33))
+        await asyncio.sleep(0)
+        batcher.release.set()
+        await asyncio.gather(first, second)
+        await batcher.drain()
+        self.assertCountEqual(
+            values(batcher.sent),
+            [("e1", "a", 1), ("e2", "a", 2), ("e3", "a", 3), ("e3", "b", 33)],
+        )
+
+    async def test_order_per_entity(self):
+        batcher = RecordingBatcher(max_in_flight=4)
+        for i in range(10):
+            await batcher.submit("e1", "T", "a", i)
+        await batcher.drain()
+        self.assertEqual([value for _, _, value in values(batcher.sent)], list(range(10)))
+
+    async def test_replay_skips_superseded_values(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = DeadLetterStore(os.path.join(directory, "dead_letters.jsonl"))
+            batcher = RecordingBatcher(
+                max_retries=0,
+                breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0),
+                dead_letters=store,
+            )
+            batcher.failures = 1
+            await batcher.submit("e1", "T", "a", 1)
+            await batcher.submit("e1", "T", "b", 1)
+            await batcher.drain()
+            self.assertTrue(store.pending())
+            self.assertEqual(batcher.sent, [])
+
+            # The newer value of a is sent first, the replay only brings back b
+            await batcher.submit("e1", "T", "a", 2)
+            await batcher.drain()
+            self.assertEqual(values(batcher.sent), [("e1", "a", 2), ("e1", "b", 1)])
+            self.assertFalse(store.pending())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Test for the circuit breaker around Orion
+    """
+
+    def test_open_and_close(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.closed)
+        breaker.record_failure()
+        self.assertFalse(breaker.closed)
+        # A single trial request is let through once the timeout has elapsed
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertTrue(breaker.record_success())
+        self.assertTrue(breaker.closed)
+
+    def test_failed_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.ready())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "gateway"))
+
+from cluster import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+    """
+    Test for the assignment of topics to gateways in hash cluster mode
+    """
+
+    topics = [f"sensors/{i}/temperature" for i in range(2000)]
+
+    def test_every_topic_has_one_owner(self):
+        ring = HashRing(["g1", "g2", "g3"])
+        owners = Counter(ring.owner(topic) for topic in self.topics)
+        self.assertEqual(set(owners), {"g1", "g2", "g3"})
+        # The topics are spread roughly evenly
+        for count in owners.values():
+            self.assertGreater(count, len(self.topics) / 6)
+
+    def test_stable(self):
+        # Every gateway computes the same owner, regardless of the order of the members
+        first = HashRing(["g1", "g2", "g3"])
+        second = HashRing(["g3", "g1", "g2", "g1"])
+        self.assertEqual(second.members, ["g1", "g2", "g3"])
+        for topic in self.topics:
+            self.assertEqual(first.owner(topic), second.owner(topic))
+
+    def test_only_topics_of_the_leaving_member_move(self):
+        before = HashRing(["g1", "g2", "g3"])
+        after = HashRing(["g1", "g2"])
+        for topic in self.topics:
+            if before.owner(topic) != "g3":
+                self.assertEqual(before.owner(topic), after.owner(topic))
+
+    def test_single_member(self):
+        ring = HashRing(["g1"])
+        self.assertEqual({ring.owner(topic) for topic in self.topics}, {"g1"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "gateway"))
+
+from control import VERSION, parse_entry
+
+
+def entry(**fields):
+    """
+    Returns the fields of a stream entry as they are read from Redis.
+    """
+    return {key.encode(): str(value).encode() for key, value in fields.items()}
+
+
+class TestParseEntry(unittest.TestCase):
+    """
+    Test for the parsing of the entries of the manage_topics stream
+    """
+
+    def test_current_version(self):
+        fields = entry(version=VERSION, config_version=7, op="subscribe", topics=json.dumps(["a", "b/+"]))
+        self.assertEqual(parse_entry(fields), (7, [("subscribe", "a"), ("subscribe", "b/+")]))
+
+    def test_version_1(self):
+        fields = entry(version=1, op="invalidate", topics=json.dumps(["a"]))
+        self.assertEqual(parse_entry(fields), (None, [("invalidate", "a")]))
+
+    def test_legacy_command(self):
+        self.assertEqual(parse_entry(entry(unsubscribe="a")), (None, [("unsubscribe", "a")]))
+        with self.assertRaises(ValueError):
+            parse_entry(entry(subscribe="a", unsubscribe="b"))
+
+    def test_invalid(self):
+        for fields in [
+            entry(version=99, op="subscribe", topics="[]"),
+            entry(version=VERSION, config_version=1, op="drop", topics="[]"),
+            entry(version=VERSION, op="subscribe", topics="[]"),
+            entry(version=VERSION, config_version="x", op="subscribe", topics="[]"),
+            entry(version=VERSION, config_version=1, op="subscribe", topics=json.dumps({"a": 1})),
+            entry(version=VERSION, config_version=1, op="subscribe", topics=json.dumps([1])),
+        ]:
+            with self.assertRaises(ValueError):
+                parse_entry(fields)
+
+
+if __name__ == "__main__":
+    unittest.main()
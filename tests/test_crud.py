@@ -146,3 +146,72 @@ class TestCRUD(TestInit):
         self.assertTrue(response.ok)
         response = requests.request("GET", settings.GATEWAY_URL + "/data/" + object_id)
         self.assertFalse(response.ok)
+
+    def test_create_bulk(self):
+        headers = {
+            'Accept': 'application/json'
+        }
+        datapoints = [
+            Datapoint(topic="topic/of/crud/bulk", jsonpath=f"$..data{i}") for i in range(10)
+        ]
+
+        # create as JSON array
+        response1 = requests.request("POST", settings.GATEWAY_URL + "/data/bulk", headers=headers,
+                                     data="[" + ",".join(datapoint.json() for datapoint in datapoints) + "]")
+        self.assertTrue(response1.ok)
+        self.assertEqual(len(json.loads(response1.text)), len(datapoints))
+
+        # create as NDJSON
+        response2 = requests.request("POST", settings.GATEWAY_URL + "/data/bulk",
+                                     headers={**headers, 'Content-Type': 'application/x-ndjson'},
+                                     data="\n".join(datapoint.json() for datapoint in datapoints))
+        self.assertTrue(response2.ok)
+        for datapoint in json.loads(response2.text):
+            response = requests.request("GET", settings.GATEWAY_URL + "/data/" + datapoint["object_id"])
+            self.assertTrue(response.ok)
+
+        # nothing is created if a single datapoint is invalid
+        invalid = Datapoint(topic="topic/of/crud/bulk", jsonpath="$..data", matchDatapoint=True)
+        response3 = requests.request("POST", settings.GATEWAY_URL + "/data/bulk", headers=headers,
+                                     data="[" + datapoints[0].json() + "," + invalid.json() + "]")
+        self.assertFalse(response3.ok)
+
+    def test_read_status(self):
+        # The gateway assigns the object ids, so the basis datapoint is looked up by its topic
+        response = requests.request("GET", settings.GATEWAY_URL + "/data/status",
+                                    params={"topic_prefix": self.unmatched_datapoint.topic})
+        self.assertTrue(response.ok)
+        datapoints = json.loads(response.text)
+        self.assertEqual(len(datapoints), 1)
+        object_id = datapoints[0]["object_id"]
+        response = requests.request("GET", settings.GATEWAY_URL + "/data/" + object_id + "/status")
+        self.assertEqual(datapoints[0]["status"], json.loads(response.text))
+
+    def test_read_pages(self):
+        datapoints = [
+            Datapoint(topic="topic/of/crud/pages", jsonpath=f"$..data{i}") for i in range(5)
+        ]
+        requests.request("POST", settings.GATEWAY_URL + "/data/bulk",
+                         data="[" + ",".join(datapoint.json() for datapoint in datapoints) + "]")
+
+        # read page by page
+        object_ids = []
+        params = {"limit": 2, "topic_prefix": "topic/of/crud/pages", "fields": "topic"}
+        while True:
+            response = requests.request("GET", settings.GATEWAY_URL + "/data", params=params)
+            self.assertTrue(response.ok)
+            page = json.loads(response.text)
+            self.assertTrue(all(set(row) == {"object_id", "topic"} for row in page))
+            object_ids.extend(row["object_id"] for row in page)
+            if "X-Next-After" not in response.headers:
+                break
+            params["after"] = response.headers["X-Next-After"]
+        self.assertEqual(len(object_ids), len(datapoints))
+        self.assertEqual(object_ids, sorted(object_ids))
+
+        # stream as NDJSON
+        response = requests.request("GET", settings.GATEWAY_URL + "/data",
+                                    params={"topic_prefix": "topic/of/crud/pages"},
+                                    headers={"Accept": "application/x-ndjson"})
+        self.assertTrue(response.ok)
+        self.assertEqual([json.loads(line)["object_id"] for line in response.text.splitlines()], object_ids)
@@ -4,6 +4,7 @@ from test_init import TestInit
 from test_settings import settings
 import requests
 import random
+import time
 
 
 class TestForwarding(TestInit):
@@ -115,3 +116,44 @@ class TestForwarding(TestInit):
         # TODO send data to unregistered datapoint via mqtt
         # TODO query datapoint from CB
 
+    def test_wildcard_topic(self):
+        headers = {
+            'Accept': 'application/json'
+        }
+        # one datapoint for all devices publishing on topic/of/<device>/wildcard
+        wildcard_datapoint = Datapoint(
+            **{
+                "object_id": "dp_forwarding:002",
+                "topic": "topic/of/+/wildcard",
+                "jsonpath": "$.data1",
+                "matchDatapoint": True,
+                "entity_id": self.test_entity.id,
+                "entity_type": self.test_entity.type,
+                "attribute_name": self.test_entity.get_attribute_names().pop()
+            }
+        )
+        response = requests.request("POST", settings.GATEWAY_URL+"/data", headers=headers,
+                                    data=wildcard_datapoint.json())
+        self.assertTrue(response.ok)
+        # give the gateway time to subscribe
+        time.sleep(1)
+
+        # send data on a topic matched by the wildcard topic
+        self.mqttc.publish(
+            topic="topic/of/device1/wildcard",
+            payload=json.dumps(self.payload_dict1)
+        )
+        time.sleep(1)
+        # query data from CB
+        res = self.cbc.get_attribute_value(
+            entity_id=wildcard_datapoint.entity_id,
+            entity_type=wildcard_datapoint.entity_type,
+            attr_name=wildcard_datapoint.attribute_name
+        )
+        # compare
+        self.assertEqual(res, self.value_1)
+
+        # invalid topic filters are rejected
+        response = requests.request("POST", settings.GATEWAY_URL+"/data", headers=headers,
+                                    data=json.dumps({"topic": "topic/#/invalid", "jsonpath": "$.data1"}))
+        self.assertEqual(response.status_code, 422)
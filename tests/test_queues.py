@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "gateway"))
+
+from asyncio_mqtt import Client
+
+from queues import BLOCK, DROP_NEWEST, DROP_OLDEST, ClientBufferDrops, MessageQueue
+from tracing import Tracer
+
+
+async def drain(queue):
+    """
+    Returns the (source, topic, payload) of all messages in the queue in the order the workers get them.
+    """
+    messages = []
+    while not queue.empty():
+        _, source, message = await queue.get()
+        messages.append((source, *message[:2]) if source == "mqtt" else (source, message))
+        queue.task_done()
+    return messages
+
+
+class TestMessageQueue(unittest.IsolatedAsyncioTestCase):
+    """
+    Test for the queue between the listeners and the workers
+    """
+
+    async def test_control_first(self):
+        queue = MessageQueue(maxsize=10)
+        await queue.put_mqtt("t", b"1")
+        queue.put_control("command")
+        await queue.put_mqtt("t", b"2")
+        self.assertEqual(
+            await drain(queue),
+            [("redis", "command"), ("mqtt", "t", b"1"), ("mqtt", "t", b"2")],
+        )
+
+    async def test_drop_oldest(self):
+        queue = MessageQueue(maxsize=2, policy=DROP_OLDEST)
+        for i in range(4):
+            await queue.put_mqtt("t", str(i).encode())
+        queue.put_control("command")  # Control messages do not count towards the limit
+        self.assertEqual(queue.dropped[DROP_OLDEST], 2)
+        self.assertEqual(
+            await drain(queue),
+            [("redis", "command"), ("mqtt", "t", b"2"), ("mqtt", "t", b"3")],
+        )
+
+    async def test_drop_newest(self):
+        queue = MessageQueue(maxsize=2, policy=DROP_NEWEST)
+        for i in range(4):
+            await queue.put_mqtt("t", str(i).encode())
+        self.assertEqual(queue.dropped[DROP_NEWEST], 2)
+        self.assertEqual(await drain(queue), [("mqtt", "t", b"0"), ("mqtt", "t", b"1")])
+
+    async def test_block(self):
+        queue = MessageQueue(maxsize=1, policy=BLOCK)
+        await queue.put_mqtt("t", b"0")
+        put = asyncio.create_task(queue.put_mqtt("t", b"1"))
+        await asyncio.sleep(0)
+        self.assertFalse(put.done())
+        await queue.get()
+        await put
+        self.assertEqual(await drain(queue), [("mqtt", "t", b"1")])
+
+    async def test_policy_override(self):
+        # Messages drained from the spool wait for room instead of being dropped
+        queue = MessageQueue(maxsize=1, policy=DROP_OLDEST)
+        await queue.put_mqtt("t", b"0")
+        put = asyncio.create_task(queue.put_mqtt("t", b"1", policy=BLOCK))
+        await asyncio.sleep(0)
+        self.assertFalse(put.done())
+        self.assertEqual(await drain(queue), [("mqtt", "t", b"0")])
+        await put
+        self.assertEqual(await drain(queue), [("mqtt", "t", b"1")])
+        self.assertFalse(queue.dropped)
+
+    async def test_coalesce(self):
+        queue = MessageQueue(maxsize=10)
+        await queue.put_mqtt("c", b"0", coalesce=True)
+        await queue.put_mqtt("t", b"1")
+        await queue.put_mqtt("c", b"2", coalesce=True)
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(await drain(queue), [("mqtt", "c", b"2"), ("mqtt", "t", b"1")])
+
+    async def test_release_dropped_traces(self):
+        tracer = Tracer()
+        traces = [tracer.start("t") for _ in range(4)]
+        queue = MessageQueue(maxsize=1, policy=DROP_OLDEST, tracer=tracer)
+        await queue.put_mqtt("c", b"0", coalesce=True, trace=traces[0])
+        await queue.put_mqtt("c", b"1", coalesce=True, trace=traces[1])  # Supersedes the pending payload
+        await queue.put_mqtt("t", b"2", trace=traces[2])  # Evicts the coalesced topic
+        queue.policy = DROP_NEWEST
+        await queue.put_mqtt("t", b"3", trace=traces[3])
+        self.assertEqual([trace.pending for trace in traces], [0, 0, 1, 0])
+
+    async def test_count_client_buffer_drops(self):
+        queue = MessageQueue(maxsize=1, policy=BLOCK)
+        drops = ClientBufferDrops(queue)
+        logger = logging.getLogger("mqtt")
+        logger.addFilter(drops)
+        self.addCleanup(logger.removeFilter, drops)
+        # The callback the client hands the messages of the broker to, it only needs a client to iterate
+        callback, _ = Client._callback_and_generator(None, queue_maxsize=1)
+        for _ in range(3):
+            callback(None)
+        self.assertEqual(queue.dropped[BLOCK], 2)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            MessageQueue(policy="drop-all")
+
+
+if __name__ == "__main__":
+    unittest.main()
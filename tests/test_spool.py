@@ -0,0 +1,106 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "gateway"))
+
+from spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+    """
+    Test for the on-disk spool
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_read_and_commit(self):
+        spool = Spool(self.directory.name)
+        self.assertFalse(spool.pending())
+        for i in range(5):
+            spool.append({"i": i})
+        spool.flush()
+        self.assertTrue(spool.pending())
+
+        records = spool.read(3)
+        self.assertEqual([record for record, _ in records], [{"i": 0}, {"i": 1}, {"i": 2}])
+        # Reading does not advance the position
+        self.assertEqual(len(spool.read(10)), 5)
+
+        # Only the records up to the committed one are drained
+        spool.commit(records[1][1])
+        self.assertEqual([record["i"] for record, _ in spool.read(10)], [2, 3, 4])
+        spool.commit(spool.read(10)[-1][1])
+        self.assertFalse(spool.pending())
+        spool.close()
+
+    def test_segments(self):
+        spool = Spool(self.directory.name, segment_size=64)
+        for i in range(20):
+            spool.append({"i": i, "padding": "x" * 16})
+        spool.flush()
+        self.assertGreater(len(spool.segments()), 1)
+
+        records = spool.read(100)
+        self.assertEqual([record["i"] for record, _ in records], list(range(20)))
+        spool.commit(records[-1][1])
+        self.assertEqual(len(spool.segments()), 1)  # Drained segments are deleted
+        spool.close()
+
+    def test_survives_restart(self):
+        spool = Spool(self.directory.name)
+        for i in range(3):
+            spool.append({"i": i})
+        spool.flush()
+        spool.commit(spool.read(1)[0][1])
+        spool.close()
+
+        spool = Spool(self.directory.name)
+        self.assertEqual([record["i"] for record, _ in spool.read(10)], [1, 2])
+        spool.close()
+
+    def test_partial_line(self):
+        spool = Spool(self.directory.name)
+        spool.append({"i": 0})
+        spool.flush()
+        spool.close()
+        with open(os.path.join(self.directory.name, f"{0:012d}.log"), "ab") as file:
+            file.write(b'{"i": 1')  # Crashed while writing
+
+        spool = Spool(self.directory.name)
+        self.assertEqual([record for record, _ in spool.read(10)], [{"i": 0}])
+        spool.close()
+
+    def test_rotation_while_draining(self):
+        # Records are appended on the event loop while the drainer flushes and reads in a thread
+        spool = Spool(self.directory.name, segment_size=256)
+        errors = []
+        stop = threading.Event()
+
+        def drain():
+            try:
+                while not stop.is_set():
+                    spool.flush()
+                    spool.read(10)
+                    spool.pending()
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=drain)
+        thread.start()
+        for i in range(3000):
+            spool.append({"i": i})
+        stop.set()
+        thread.join()
+        self.assertEqual(errors, [])
+        spool.flush()
+        self.assertEqual([record["i"] for record, _ in spool.read(5000)], list(range(3000)))
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
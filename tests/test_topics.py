@@ -0,0 +1,115 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "gateway"))
+
+from topics import SubscriptionPlan, TopicTrie, covers
+
+
+class TestTopicTrie(unittest.TestCase):
+    """
+    Test for the trie of MQTT topic filters
+    """
+
+    def setUp(self):
+        self.trie = TopicTrie()
+        for topic_filter in ["a/b/c", "a/+/c", "a/#", "+/b/#", "x/y"]:
+            self.trie.insert(topic_filter, topic_filter)
+
+    def test_match(self):
+        self.assertCountEqual(self.trie.match("a/b/c"), ["a/b/c", "a/+/c", "a/#", "+/b/#"])
+        self.assertCountEqual(self.trie.match("a"), ["a/#"])
+        self.assertCountEqual(self.trie.match("x/y"), ["x/y"])
+        self.assertEqual(self.trie.match("x/y/z"), [])
+
+    def test_match_system_topics(self):
+        self.trie.insert("#", "#")
+        self.trie.insert("$SYS/#", "$SYS/#")
+        self.assertEqual(self.trie.match("$SYS/b/c"), ["$SYS/#"])
+
+    def test_remove(self):
+        self.assertEqual(len(self.trie), 5)
+        self.assertEqual(self.trie.remove("a/#"), "a/#")
+        self.assertIsNone(self.trie.remove("a/#"))
+        self.assertIsNone(self.trie.remove("a/b"))
+        self.assertEqual(len(self.trie), 4)
+        self.assertNotIn("a/#", self.trie)
+        self.assertCountEqual(self.trie.match("a/b/c"), ["a/b/c", "a/+/c", "+/b/#"])
+
+    def test_overlapping(self):
+        self.assertCountEqual(self.trie.overlapping("a/+/c"), ["a/b/c", "a/+/c", "a/#", "+/b/#"])
+        self.assertCountEqual(self.trie.overlapping("x/#"), ["x/y", "+/b/#"])
+        self.assertTrue(self.trie.overlaps("q/b/r"))
+        self.assertFalse(self.trie.overlaps("q/r"))
+
+    def test_covers(self):
+        self.assertTrue(covers("a/#", "a/+/c"))
+        self.assertTrue(covers("a/+/c", "a/b/c"))
+        self.assertFalse(covers("a/+/c", "a/#"))
+        self.assertFalse(covers("+/b", "$SYS/b"))
+
+
+class TestSubscriptionPlan(unittest.TestCase):
+    """
+    Test for the planning of the subscriptions
+    """
+
+    def test_exact(self):
+        plan = SubscriptionPlan()
+        self.assertEqual(plan.add(["a/1", "a/2"]), (["a/1", "a/2"], []))
+        self.assertEqual(plan.add(["a/1"]), ([], []))
+        self.assertEqual(plan.remove(["a/1", "b"]), ([], ["a/1"]))
+        self.assertEqual(plan.topics, {"a/2"})
+
+    def test_compaction(self):
+        plan = SubscriptionPlan(min_group=3)
+        new_filters, _ = plan.add(["s/1/t", "s/2/t", "s/3/t", "other"])
+        self.assertCountEqual(new_filters, ["s/+/t", "other"])
+        self.assertEqual(plan.add(["s/4/t"]), ([], []))  # Covered by the existing filter
+        self.assertEqual(plan.remove(["s/1/t", "s/2/t", "s/3/t"]), ([], []))
+        self.assertEqual(plan.remove(["s/4/t"]), ([], ["s/+/t"]))
+
+    def test_wildcard_takes_over(self):
+        plan = SubscriptionPlan()
+        plan.add(["d/1/t", "d/2/t"])
+        new_filters, replaced = plan.add(["d/+/t"])
+        self.assertEqual(new_filters, ["d/+/t"])
+        self.assertCountEqual(replaced, ["d/1/t", "d/2/t"])
+        self.assertEqual(len(plan), 1)
+
+    def test_remove_wildcard(self):
+        # The topics taken over by a wildcard topic are subscribed to on their own again once it is removed
+        plan = SubscriptionPlan()
+        plan.add(["d/1/t", "d/2/t"])
+        plan.add(["d/+/t"])
+        new_filters, unused = plan.remove(["d/+/t"])
+        self.assertCountEqual(new_filters, ["d/1/t", "d/2/t"])
+        self.assertEqual(unused, ["d/+/t"])
+        self.assertEqual(plan.topics, {"d/1/t", "d/2/t"})
+        self.assertEqual(plan.remove(["d/1/t", "d/2/t"])[1], ["d/1/t", "d/2/t"])
+        self.assertEqual(len(plan), 0)
+
+    def test_remove_wildcard_with_covered_wildcard(self):
+        plan = SubscriptionPlan()
+        plan.add(["a/#", "a/+/c", "a/b/c"])
+        self.assertEqual(plan.remove(["a/#"]), (["a/+/c"], ["a/#"]))
+        self.assertEqual(plan.topics, {"a/+/c", "a/b/c"})
+
+    def test_remove_wildcard_planned_again(self):
+        # The remaining topics are compacted into the same filter, which stays subscribed
+        plan = SubscriptionPlan(min_group=2)
+        plan.add(["d/1/t", "d/2/t", "d/+/t"])
+        self.assertEqual(plan.remove(["d/+/t"]), ([], []))
+        self.assertEqual(plan.topics, {"d/1/t", "d/2/t"})
+        self.assertEqual(len(plan), 1)
+
+    def test_drop(self):
+        plan = SubscriptionPlan()
+        plan.add(["a/+", "a/1"])
+        self.assertEqual(plan.drop("a/+"), {"a/+", "a/1"})
+        self.assertNotIn("a/1", plan)
+
+
+if __name__ == "__main__":
+    unittest.main()